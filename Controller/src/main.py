@@ -7,22 +7,10 @@ from ssd1306 import SSD1306_I2C
 import framebuf
 import uasyncio as asyncio
 import sys
-import math
 from time import ticks_ms
 import json
 import ubinascii
-
-def adc2celsius(adc, R25=50000, BETA=3950):
-	if adc <= 1:
-		return 0
-	R1 = 100000
-	Rt = 65535 / adc - 1
-	if Rt <= 0:
-		return 0
-	v = math.log(R1 / Rt / R25) / BETA + 1.0 / 298.15
-	if v == 0:
-		return 0
-	return 1 / v - 273.15
+from thermistor import ThermistorTable
 
 @rp2.asm_pio()
 def PIO_counter():
@@ -249,6 +237,8 @@ class Application:
 		cnt = 0
 		adc0 = ADC(26)
 		adc1 = ADC(27)
+		therm0 = ThermistorTable(R25=10000)
+		therm1 = ThermistorTable(R25=50000)
 		acc0 = 0
 		acc1 = 0
 		flow = 0.0
@@ -258,8 +248,8 @@ class Application:
 			acc1 += adc1.read_u16()
 			cnt += 1
 			if cnt >= 10:
-				self.temp_out = adc2celsius(acc0 / cnt, R25=10000)
-				self.temp_in = adc2celsius(acc1 / cnt, R25=50000)
+				self.temp_out = therm0.convert(acc0 / cnt)
+				self.temp_in = therm1.convert(acc1 / cnt)
 				self.flow_df = self.fc.read() / 6.6
 				cnt = acc0 = acc1 = 0
 				self.status_spin()
@@ -0,0 +1 @@
+../../Controller2/src/thermistor.py
\ No newline at end of file
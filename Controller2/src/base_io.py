@@ -4,10 +4,17 @@ from time import monotonic
 import asyncio
 import os
 import math
+import bisect
 from logging import debug, info, warning, error
 import serial
+import serial_asyncio
 import json
-from collections import deque
+import re
+import sys
+import glob
+import struct
+from array import array
+from thermistor import adc2celsius, ThermistorTable
 
 # Output GPIO names mapping:
 outputs = {
@@ -20,41 +27,140 @@ outputs = {
 	"fan": "fan",
 }
 
-def adc2celsius(adc, R25=50000, BETA=3950):
-	if adc <= 1:
-		return 0
-	R1 = 100000
-	Rt = 65535 / adc - 1
-	if Rt <= 0:
-		return 0
-	v = math.log(R1 / Rt / R25) / BETA + 1.0 / 298.15
-	if v == 0:
-		return 0
-	return 1 / v - 273.15
-
 class Filter:
+	"""
+	Triangular time-weighted average over the last n samples not older than
+	tmax seconds. Keeps running sums over a preallocated ring buffer, so a
+	read() is O(1) (amortized) regardless of n.
+	"""
+	RESUM = 64 # Recompute the sums from scratch every RESUM * n reads
+
 	def __init__(self, n, tmax):
+		self.n = n
 		self.tmax = tmax
-		self.queue = deque(maxlen=n)
+		self.ts = array("d", bytes(8 * n))
+		self.vals = array("d", bytes(8 * n))
+		self.head = 0 # Next slot to write
+		self.count = 0
+		self.t0 = monotonic() # Timestamps are stored relative to t0
+		self.reads = 0
+		self._reset_sums()
+
+	def _reset_sums(self):
+		self.sv = 0.0
+		self.st = 0.0
+		self.stv = 0.0
+
+	def _resum(self):
+		self._reset_sums()
+		for k in range(self.count):
+			i = (self.head - 1 - k) % self.n
+			self._add(self.ts[i], self.vals[i])
+
+	def _add(self, t, v):
+		self.sv += v
+		self.st += t
+		self.stv += t * v
+
+	def _remove_oldest(self):
+		i = (self.head - self.count) % self.n
+		t, v = self.ts[i], self.vals[i]
+		self.sv -= v
+		self.st -= t
+		self.stv -= t * v
+		self.count -= 1
 
 	def read(self, vin):
-		self.queue.append((monotonic(), vin))
+		t = monotonic() - self.t0
+		if self.count == self.n:
+			self._remove_oldest()
+		self.ts[self.head] = t
+		self.vals[self.head] = vin
+		self.head = (self.head + 1) % self.n
+		self.count += 1
+		self._add(t, vin)
+		# Expire old samples, always keeping the one just added
+		while self.count > 1 and t - self.ts[(self.head - self.count) % self.n] > self.tmax:
+			self._remove_oldest()
+		self.reads += 1
+		if self.reads % (self.RESUM * self.n) == 0:
+			self._resum()
 		return self.wavg()
 
 	def wavg(self):
-		acc = 0
-		wacc = 0
-		ts0, v0 = self.queue[-1]
-		for ts, val in self.queue:
-			dt = ts0 - ts
-			if dt > self.tmax:
-				continue
-			w = self.tmax - dt
-			acc += w * val
-			wacc += w
-		if wacc == 0:
-			return v0
-		return acc / wacc
+		# sum((tmax - (t0 - ts)) * v) / sum(tmax - (t0 - ts))
+		t0 = self.ts[(self.head - 1) % self.n]
+		c = self.tmax - t0
+		wacc = c * self.count + self.st
+		if wacc <= 0:
+			return self.vals[(self.head - 1) % self.n]
+		return (c * self.sv + self.stv) / wacc
+
+class EMAFilter:
+	"""
+	Exponential moving average with time constant tau seconds, independent
+	of the sample rate.
+	"""
+	def __init__(self, tau):
+		self.tau = tau
+		self.value = None
+		self.t = None
+
+	def read(self, vin):
+		t = monotonic()
+		if self.value is None:
+			self.value = vin
+		else:
+			alpha = 1.0 - math.exp(-(t - self.t) / self.tau)
+			self.value += alpha * (vin - self.value)
+		self.t = t
+		return self.value
+
+class MedianFilter:
+	"""
+	Median of the last n samples, rejects single spikes. Keeps the window
+	sorted, so an update costs a binary search and a short memmove.
+	"""
+	def __init__(self, n=5):
+		self.n = n
+		self.ring = array("d", bytes(8 * n))
+		self.head = 0
+		self.sorted = []
+
+	def read(self, vin):
+		if len(self.sorted) == self.n:
+			del self.sorted[bisect.bisect_left(self.sorted, self.ring[self.head])]
+		self.ring[self.head] = vin
+		self.head = (self.head + 1) % self.n
+		bisect.insort(self.sorted, vin)
+		m = len(self.sorted)
+		if m % 2:
+			return self.sorted[m // 2]
+		return (self.sorted[m // 2 - 1] + self.sorted[m // 2]) / 2
+
+class KalmanFilter:
+	"""
+	Scalar Kalman filter for a slowly drifting value. q is the process
+	noise variance per second, r the measurement noise variance.
+	"""
+	def __init__(self, q=0.01, r=1.0):
+		self.q = q
+		self.r = r
+		self.x = None
+		self.p = r
+		self.t = None
+
+	def read(self, vin):
+		t = monotonic()
+		if self.x is None:
+			self.x = vin
+		else:
+			self.p += self.q * (t - self.t)
+			k = self.p / (self.p + self.r)
+			self.x += k * (vin - self.x)
+			self.p *= 1 - k
+		self.t = t
+		return self.x
 
 class Relay:
 	def __init__(self, name, default=0):
@@ -164,8 +270,44 @@ class Bidir:
 		self.turn_off()
 
 class sysfs:
+	"""
+	Attribute files are kept open and re-read with pread() at offset 0,
+	which makes sysfs produce a fresh value without another open/close.
+	"""
+	BUFSIZE = 64 # Enough for any numeric attribute
+
 	def __init__(self, path):
 		self.path = path
+		self.fds = {}
+		self.buf = bytearray(self.BUFSIZE)
+
+	def _fd(self, name):
+		fd = self.fds.get(name, None)
+		if fd is None:
+			fd = os.open(os.path.join(self.path, name), os.O_RDONLY)
+			self.fds[name] = fd
+		return fd
+
+	def _close_fd(self, name):
+		fd = self.fds.pop(name, None)
+		if fd is not None:
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+	def close(self):
+		for name in list(self.fds):
+			self._close_fd(name)
+
+	def _pread(self, name):
+		# Returns the number of bytes read into self.buf. A stale fd (e.g.
+		# after a driver rebind) is reopened once.
+		try:
+			return os.preadv(self._fd(name), [self.buf], 0)
+		except OSError:
+			self._close_fd(name)
+		return os.preadv(self._fd(name), [self.buf], 0)
 
 	def sys_write(self, name, value):
 		with open(os.path.join(self.path, name), "w") as f:
@@ -176,10 +318,12 @@ class sysfs:
 			return f.read()
 
 	def sys_read_int(self, name):
-		return int(self.sys_read(name).strip(" \r\n"))
+		n = self._pread(name)
+		return int(self.buf[:n])
 
 	def sys_read_float(self, name):
-		return float(self.sys_read(name).strip(" \r\n"))
+		n = self._pread(name)
+		return float(self.buf[:n])
 
 class Counter(sysfs):
 	def __init__(self, path):
@@ -246,14 +390,18 @@ class Frequency:
 		return ret
 
 class FlowRate:
-	def __init__(self, freq, fact=6.6):
+	def __init__(self, freq, fact=6.6, filt=None):
 		self.freq = freq
 		self.fact = fact
 		self.freq.start()
-		self.filter = Filter(10, 5)
+		self.filter = filt if filt is not None else Filter(10, 5)
 
 	def get_value(self):
-		return round(self.filter.read(self.freq.get_value() / self.fact), 2)
+		f = self.freq.get_value()
+		if f is None:
+			# Counter wrapped or was reset
+			return None
+		return round(self.filter.read(f / self.fact), 2)
 
 class IioAdc(sysfs):
 	def __init__(self, path, channel):
@@ -267,66 +415,385 @@ class IioAdc(sysfs):
 	def get_raw(self):
 		return self.sys_read_int(f"in_voltage{self.channel}_raw")
 
+class IioBufferedAdc(sysfs):
+	"""
+	Buffered (triggered) IIO acquisition of several ADC channels. Samples
+	are read in bulk from /dev/iio:deviceX and averaged per channel, so each
+	get_raw() of a channel returns the mean of all samples since the last
+	read instead of a single conversion. Raises OSError if the device or
+	trigger doesn't support it, use IioAdc then.
+	"""
+	TYPE_RE = re.compile(r"(be|le):(s|u)(\d+)/(\d+)(?:X(\d+))?>>(\d+)")
+	HRTIMER_CONFIGFS = "/sys/kernel/config/iio/triggers/hrtimer"
+	MAX_AGE = 0.1 # Seconds, channels read within this time share one bulk read
+	STALE = 2.0 # Seconds without samples before a channel reads as None
+
+	def __init__(self, path, channels, trigger="kachel-adc", sampling_frequency=500, buflen=1024):
+		super().__init__(path)
+		self.channels = tuple(channels)
+		self.scale = {}
+		self.avg = {}
+		self.t_update = 0
+		self.t_sample = 0
+		self.samples = 0
+		self.fd = None
+		self.enabled = False
+		try:
+			self._setup(trigger, sampling_frequency, buflen)
+		except BaseException:
+			# Leave the device usable for single sample (sysfs) reads
+			self.close()
+			raise
+
+	def _setup(self, trigger, sampling_frequency, buflen):
+		self._write_if_changed("buffer/enable", 0)
+		for f in glob.glob(os.path.join(self.path, "scan_elements", "*_en")):
+			name = os.path.basename(f)
+			want = name in [f"in_voltage{c}_en" for c in self.channels]
+			self._write_if_changed(f"scan_elements/{name}", int(want))
+		self._setup_trigger(trigger, sampling_frequency)
+		self._parse_scan_layout()
+		self.sys_write("buffer/length", buflen)
+		self.rbuf = bytearray(buflen * self.scansize)
+		self.sys_write("buffer/enable", 1)
+		self.enabled = True
+		self.fd = os.open(os.path.join("/dev", os.path.basename(self.path.rstrip("/"))), os.O_RDONLY | os.O_NONBLOCK)
+		for c in self.channels:
+			try:
+				self.scale[c] = self.sys_read_float(f"in_voltage{c}_scale")
+			except OSError:
+				self.scale[c] = self.sys_read_float("in_voltage_scale")
+
+	def _write_if_changed(self, name, value):
+		if self.sys_read(name).strip() != str(value):
+			self.sys_write(name, value)
+
+	def _find_trigger(self, name):
+		for f in glob.glob("/sys/bus/iio/devices/trigger*/name"):
+			with open(f) as tf:
+				if tf.read().strip() == name:
+					return os.path.dirname(f)
+		return None
+
+	def _setup_trigger(self, name, freq):
+		tdir = self._find_trigger(name)
+		if tdir is None:
+			# Create an hrtimer trigger through configfs
+			os.makedirs(os.path.join(self.HRTIMER_CONFIGFS, name), exist_ok=True)
+			tdir = self._find_trigger(name)
+			if tdir is None:
+				raise OSError(f"IIO trigger {name} not found")
+		with open(os.path.join(tdir, "sampling_frequency"), "w") as f:
+			f.write(str(freq))
+		self._write_if_changed("trigger/current_trigger", name)
+
+	def _parse_scan_layout(self):
+		"""
+		Work out the packed layout of one scan from scan_elements: enabled
+		elements in index order, each aligned to its storage size.
+		"""
+		elems = []
+		for f in glob.glob(os.path.join(self.path, "scan_elements", "*_en")):
+			base = os.path.basename(f)[:-3]
+			if self.sys_read_int(f"scan_elements/{base}_en") != 1:
+				continue
+			idx = self.sys_read_int(f"scan_elements/{base}_index")
+			m = self.TYPE_RE.match(self.sys_read(f"scan_elements/{base}_type").strip())
+			if m is None:
+				raise OSError(f"IIO: unsupported scan element type for {base}")
+			endian, sign, bits, storage, repeat, shift = m.groups()
+			elems.append((idx, base, endian, sign == "s", int(bits), int(storage) // 8, int(repeat or 1), int(shift)))
+		elems.sort()
+		fmt = "<" if elems and elems[0][2] == "le" else ">"
+		codes = {1: "b", 2: "h", 4: "i", 8: "q"}
+		offset = 0
+		self.elements = {}
+		pos = 0
+		for idx, base, endian, signed, bits, size, repeat, shift in elems:
+			if offset % size:
+				pad = size - offset % size
+				fmt += f"{pad}x"
+				offset += pad
+			code = codes[size] if signed else codes[size].upper()
+			fmt += code * repeat
+			offset += size * repeat
+			m = re.match(r"in_voltage(\d+)$", base)
+			if m is not None:
+				self.elements[int(m.group(1))] = (pos, signed, bits, 8 * size, shift)
+			pos += repeat
+		self.nelem = pos
+		maxsize = max([e[5] for e in elems] or [1])
+		if offset % maxsize:
+			fmt += f"{maxsize - offset % maxsize}x"
+		self.scan = struct.Struct(fmt)
+		self.scansize = self.scan.size
+		# Fast path: one plain native array if all elements are equal words
+		same = len(set((e[2], e[3], e[5], e[6]) for e in elems)) == 1
+		self.typecode = None
+		if same and self.scansize == len(elems) * elems[0][5] and (elems[0][2] == "le") == (sys.byteorder == "little"):
+			self.typecode = fmt[1]
+		for c in self.channels:
+			if c not in self.elements:
+				raise OSError(f"IIO: channel {c} not in scan")
+
+	def _decode(self, data):
+		"""
+		Returns {channel: (sum, count)} of the raw values in data.
+		"""
+		if self.typecode is not None:
+			a = array(self.typecode)
+			a.frombytes(data)
+			cols = {c: a[self.elements[c][0]::self.nelem] for c in self.channels}
+		else:
+			rows = list(self.scan.iter_unpack(data))
+			cols = {c: [r[self.elements[c][0]] for r in rows] for c in self.channels}
+		ret = {}
+		for c, col in cols.items():
+			pos, signed, bits, storagebits, shift = self.elements[c]
+			if shift == 0 and bits == storagebits:
+				ret[c] = (sum(col), len(col))
+				continue
+			mask = (1 << bits) - 1
+			acc = 0
+			for v in col:
+				v = (v >> shift) & mask
+				if signed and v & (1 << (bits - 1)):
+					v -= 1 << bits
+				acc += v
+			ret[c] = (acc, len(col))
+		return ret
+
+	def update(self):
+		"""
+		Read everything the kernel has buffered since the last call.
+		"""
+		self.t_update = monotonic()
+		acc = {c: [0, 0] for c in self.channels}
+		while True:
+			try:
+				n = os.readv(self.fd, [self.rbuf])
+			except BlockingIOError:
+				break
+			n -= n % self.scansize
+			if n <= 0:
+				break
+			for c, (total, cnt) in self._decode(memoryview(self.rbuf)[:n]).items():
+				acc[c][0] += total
+				acc[c][1] += cnt
+			if n < len(self.rbuf):
+				break
+		for c, (total, cnt) in acc.items():
+			if cnt:
+				self.avg[c] = total / cnt
+				self.samples += cnt
+				self.t_sample = self.t_update
+
+	def get_raw(self, channel):
+		if monotonic() - self.t_update > self.MAX_AGE:
+			self.update()
+		if monotonic() - self.t_sample > self.STALE:
+			# Trigger stopped or device gone
+			return None
+		return self.avg.get(channel, None)
+
+	def channel(self, channel):
+		return IioBufferedChannel(self, channel)
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+		if self.enabled:
+			self.enabled = False
+			try:
+				self.sys_write("buffer/enable", 0)
+			except OSError as e:
+				error(f"IIO: Can't disable buffer of {self.path}: {e}")
+		super().close()
+
+class IioBufferedChannel:
+	"""
+	One channel of an IioBufferedAdc with the IioAdc interface.
+	"""
+	def __init__(self, adc, channel):
+		self.adc = adc
+		self.channel = channel
+		self.scale = adc.scale[channel]
+
+	def get_raw(self):
+		return self.adc.get_raw(self.channel)
+
+	def get_value(self):
+		raw = self.get_raw()
+		if raw is None:
+			return None
+		return raw * self.scale / 1000.0
+
 class Temperature:
-	def __init__(self, adc, R25=50000, BETA=3950):
+	def __init__(self, adc, R25=50000, BETA=3950, filt=None):
 		self.R25 = R25
 		self.BETA = BETA
 		self.adc = adc
-		self.filter = Filter(10, 10)
+		self.table = ThermistorTable(R25, BETA)
+		self.filter = filt if filt is not None else Filter(10, 10)
 
 	def get_value(self):
-		return round(self.filter.read(adc2celsius(65535 * self.adc.get_raw() / 3300 , R25=self.R25, BETA=self.BETA)), 2)
+		raw = self.adc.get_raw()
+		if raw is None:
+			return None
+		return round(self.filter.read(self.table.convert(65535 * raw / 3300)), 2)
 
 class SerialJSONSensor:
-	def __init__(self, sj, field, scale=1):
+	def __init__(self, sj, field, scale=1, max_age=None):
 		self.sj = sj
 		self.field = field
 		self.scale = scale
+		self.max_age = max_age
 
 	def get_value(self):
-		return self.sj.get_value(self.field, self.scale)
+		return self.sj.get_value(self.field, self.scale, self.max_age)
+
+	def age(self):
+		return self.sj.get_age(self.field)
+
+class SerialJSONProtocol(asyncio.Protocol):
+	def __init__(self, sj):
+		self.sj = sj
+
+	def connection_made(self, transport):
+		self.sj.transport = transport
+
+	def data_received(self, data):
+		self.sj.feed(data)
+
+	def connection_lost(self, exc):
+		warning(f"SerialJSON: Connection lost: {exc!r}")
+		self.sj.transport = None
 
 class SerialJSON:
-	def __init__(self, port, baud):
+	"""
+	Line based JSON objects from a serial port. Every complete line is
+	decoded as soon as it arrives, all lines of a read in one go. Each field
+	keeps the time it was last received.
+	"""
+	MAX_BUFFER = 4096 # Bytes without a newline before the buffer is dropped
+
+	def __init__(self, port, baud, max_age=30.0, interval_weight=0.1):
 		self.s = serial.Serial(port, baud, timeout=0)
-		self.loop = None
-		self.current = None
-		self.rbuf = b''
+		self.transport = None
+		self.rbuf = bytearray()
+		self.scanpos = 0 # rbuf before this has no newline
+		self.discard = False # Dropping the rest of an overlong line
+		self.max_age = max_age # Seconds after which a field reads as None
+		self.fields = {} # field: [value, monotonic timestamp, count, mean interval]
+		# Weight of the newest interval in the mean interval (EMA) of a field.
+		# 0.1 averages over roughly the last 10 updates.
+		self.interval_weight = interval_weight
+		self.frames = 0
+		self.bad_frames = 0
+		self.overflows = 0
 
 	def ensure_reader(self):
-		if self.loop is not None:
+		if self.transport is not None:
 			return
-		self.loop = asyncio.get_running_loop()
-		self.loop.add_reader(self.s.fileno(), self._handle_read)
-
-	def _handle_read(self):
-		l = self.s.read_until()
-		if len(l) == 0:
-			return
-		self.rbuf += l
-		if not b'\n' in self.rbuf:
+		if not self.s.is_open:
+			try:
+				self.s.open()
+			except serial.SerialException as e:
+				warning(f"SerialJSON: Can't reopen port: {e}")
+				return
+		# connection_made() only runs in the next loop iteration, so set the
+		# transport here, or every read in this iteration creates another one
+		self.transport = serial_asyncio.SerialTransport(asyncio.get_running_loop(), SerialJSONProtocol(self), self.s)
+
+	def feed(self, data):
+		rbuf = self.rbuf
+		rbuf += data
+		start = 0
+		while True:
+			end = rbuf.find(b'\n', max(start, self.scanpos))
+			if end < 0:
+				break
+			if self.discard:
+				# End of a line that overflowed, resync after it
+				self.discard = False
+			elif end - start > self.MAX_BUFFER:
+				self._overflow(end - start)
+			else:
+				self._handle_line(rbuf[start:end])
+			start = end + 1
+		if start:
+			del rbuf[:start]
+		self.scanpos = len(rbuf)
+		if len(rbuf) > self.MAX_BUFFER:
+			if not self.discard:
+				self._overflow(len(rbuf))
+				self.discard = True
+			rbuf.clear()
+			self.scanpos = 0
+
+	def _overflow(self, n):
+		warning(f"SerialJSON: No end of line in {n} bytes, dropping the line")
+		self.overflows += 1
+		self.bad_frames += 1
+
+	def _handle_line(self, data):
+		data = data.strip(b' \r\x00')
+		if not data:
 			return
-		data, self.rbuf = self.rbuf.split(b'\n',1)
-		data = data.strip(b' \r\n')
 		try:
 			obj = json.loads(data)
 		except (json.JSONDecodeError, UnicodeDecodeError):
-			info("SerialJSON: Got wrong JSON data: {data!r}")
-		else:
-			if self.current is None:
-				self.current = obj
-			else:
-				self.current.update(obj)
+			obj = None
+		if not isinstance(obj, dict):
+			self.bad_frames += 1
+			info(f"SerialJSON: Got wrong JSON data: {bytes(data)!r}")
+			return
+		self.frames += 1
+		ts = monotonic()
+		for k, v in obj.items():
+			f = self.fields.get(k, None)
+			if f is None:
+				self.fields[k] = [v, ts, 1, 0.0]
+				continue
+			dt = ts - f[1]
+			# Mean interval as EMA, seeded with the first interval
+			f[3] = dt if f[2] == 1 else f[3] + self.interval_weight * (dt - f[3])
+			f[0] = v
+			f[1] = ts
+			f[2] += 1
+
+	def get_age(self, field):
+		f = self.fields.get(field, None)
+		if f is None:
+			return None
+		return monotonic() - f[1]
 
-	def get_value(self, field, scale=1):
+	def get_value(self, field, scale=1, max_age=None):
+		"""
+		Last value of field times scale, or None if it is missing, not a
+		number or older than max_age (default self.max_age) seconds.
+		"""
 		self.ensure_reader()
-		if self.current is None:
+		f = self.fields.get(field, None)
+		if f is None:
 			return None
-		try:
-			ret = self.current[field]
-		except KeyError:
-			ret = None
-		return ret * scale
-
-	def get_sensor(self, field, scale=1):
-		return SerialJSONSensor(self, field, scale)
+		if max_age is None:
+			max_age = self.max_age
+		if monotonic() - f[1] > max_age:
+			return None
+		if isinstance(f[0], bool) or not isinstance(f[0], (int, float)):
+			return None
+		return f[0] * scale
+
+	def field_stats(self):
+		"""
+		Returns {field: {"count", "age", "rate"}}, rate in updates per second,
+		None until a field was received twice.
+		"""
+		t = monotonic()
+		return {k: {"count": f[2], "age": t - f[1], "rate": 1 / f[3] if f[2] > 1 and f[3] > 0 else None}
+				for k, f in self.fields.items()}
+
+	def get_sensor(self, field, scale=1, max_age=None):
+		return SerialJSONSensor(self, field, scale, max_age)
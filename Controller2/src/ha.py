@@ -175,6 +175,10 @@ class HATemperatureSetpoint(HANumber):
 		super().__init__(ha, uid, objid, name, "temperature", "°C", val, 16.0, 22.0)
 
 class HomeAssistant:
+	RESTAPI_TIMEOUT = 2.0 # Seconds, keep the sensor tick going if HA is slow
+	RESTAPI_CONNECTIONS = 4
+	WEBSOCKET_RETRY = 10.0 # Seconds between websocket connection attempts
+
 	def __init__(self, mqttserver, mqttuser, mqttpasswd, base="kachel"):
 		mqlogger = logging.getLogger("gmqtt")
 		mqlogger.setLevel(logging.WARNING)
@@ -187,6 +191,12 @@ class HomeAssistant:
 		self.switches = {}
 		self.sensors = {}
 		self.numbers = {}
+		self.session = None
+		self.sensor_watches = {}
+		self.ws_connected = False
+		self.ws_events = 0
+		# Background tasks, referenced until done so they can't be garbage collected
+		self.tasks = set()
 		self.hostname = f"{uuid.getnode():012x}"
 		self.baseid = f"{self.hostname}_{base}"
 		self.topicbase_stem = f"{base}/{self.hostname}/"
@@ -289,8 +299,26 @@ class HomeAssistant:
 				cnt = 0
 			cnt += 1
 
+	def _task_done(self, task):
+		self.tasks.discard(task)
+		if task.cancelled():
+			return
+		e = task.exception()
+		if e is not None:
+			error(f"HA: Task {task.get_name()} died: {e!r}", exc_info=e)
+		else:
+			error(f"HA: Task {task.get_name()} ended")
+
+	def start_task(self, coro):
+		task = asyncio.create_task(coro, name=coro.__name__)
+		self.tasks.add(task)
+		task.add_done_callback(self._task_done)
+		return task
+
 	async def run(self):
-		asyncio.create_task(self.state_updater())
+		self.start_task(self.state_updater())
+		if self.sensor_watches:
+			self.start_task(self.sensor_state_subscriber())
 		while True:
 			try:
 				await self.client.connect(self.mqttserver)
@@ -358,23 +386,43 @@ class HomeAssistant:
 	def create_temperature_setpoint(self, objid, name, initval):
 		return self._create_number(objid, name, HATemperatureSetpoint, "Tsp", initval)
 
+	def _restapi_session(self):
+		# One long-lived session, so the TCP connection to HA is kept alive
+		# and reused instead of being set up again for every request.
+		if self.session is None or self.session.closed:
+			baseurl = f"http://{self.mqttserver}:8123"
+			headers = {
+				"Authorization": f"Bearer {self.ha_token}",
+				"content-type": "application/json",
+			}
+			self.session = aiohttp.ClientSession(baseurl, headers=headers,
+					connector=aiohttp.TCPConnector(limit=self.RESTAPI_CONNECTIONS, keepalive_timeout=60),
+					timeout=aiohttp.ClientTimeout(total=self.RESTAPI_TIMEOUT))
+		return self.session
+
+	async def restapi_close(self):
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
 	async def restapi_get(self, url):
-		baseurl = f"http://{self.mqttserver}:8123"
 		url = f"/api/{url}"
-		headers = {
-			"Authorization": f"Bearer {self.ha_token}",
-			"content-type": "application/json",
-		}
 		ret = None
 		try:
-			async with aiohttp.ClientSession(baseurl, headers=headers) as session:
-				async with session.get(url) as resp:
-					ret = await resp.json()
+			async with self._restapi_session().get(url) as resp:
+				ret = await resp.json()
 		except aiohttp.ServerDisconnectedError:
 			ret = None
 		except aiohttp.client_exceptions.ClientOSError:
 			warning("HA: aiohttp: Connection reset by peer")
 			ret = None
+		except asyncio.TimeoutError:
+			warning(f"HA: aiohttp: Timeout getting {url}")
+			ret = None
+		except (aiohttp.ClientError, ValueError) as e:
+			# HA answers 401 or 502 with a text body
+			warning(f"HA: aiohttp: Error getting {url}: {e!r}")
+			ret = None
 		return ret
 
 	async def get_sensor_state_and_timestamp(self, objid):
@@ -383,21 +431,103 @@ class HomeAssistant:
 		except aiohttp.client_exceptions.ClientConnectorError:
 			error(f"Connection error trying to get sensor.{objid}")
 			return None, None
+		return self._parse_sensor_state(objid, obj)
+
+	async def get_sensor_states_and_timestamps(self, objids):
+		"""
+		Fetch several sensors concurrently. Returns {objid: (state, timestamp)}.
+		"""
+		res = await asyncio.gather(*[self.get_sensor_state_and_timestamp(o) for o in objids])
+		return dict(zip(objids, res))
+
+	def _parse_sensor_state(self, objid, obj):
 		if obj is None:
 			error(f"HA rest API returen None for sensor {objid}")
 			return None, None
 		try:
 			state = obj["state"]
 			lupd = obj["last_updated"]
-		except KeyError:
+		except (KeyError, TypeError):
 			error(f"HA Error: Sensor {objid} does not exist?")
 			return None, None
 		try:
 			state = float(state)
-		except ValueError:
+			ts = datetime.fromisoformat(lupd)
+		except (ValueError, TypeError):
 			if not self.warned_once.get(objid, False):
-				error(f"HA Error: Sensor {objid} state is non numeric.")
+				error(f"HA Error: Sensor {objid} state is non numeric or has no valid timestamp.")
 				self.warned_once[objid] = True
 			return None, None
-		ts = datetime.fromisoformat(lupd)
 		return state, ts.timestamp()
+
+	def watch_sensor(self, objid, handler):
+		"""
+		Call handler(state, timestamp) whenever HA sensor.<objid> changes.
+		state and timestamp are None if the sensor is unavailable.
+		"""
+		self.sensor_watches[objid] = handler
+
+	async def _refresh_watched_sensors(self):
+		objids = list(self.sensor_watches)
+		states = await self.get_sensor_states_and_timestamps(objids)
+		for objid, (state, ts) in states.items():
+			self.sensor_watches[objid](state, ts)
+
+	async def _ws_receive(self, ws):
+		msg = await ws.receive()
+		if msg.type != aiohttp.WSMsgType.TEXT:
+			raise ConnectionError(f"HA websocket closed: {msg.type!r}")
+		return json.loads(msg.data)
+
+	async def _ws_session(self):
+		async with self._restapi_session().ws_connect("/api/websocket", heartbeat=30) as ws:
+			obj = await self._ws_receive(ws)
+			if obj.get("type") != "auth_required":
+				raise ConnectionError(f"HA websocket: unexpected message {obj!r}")
+			await ws.send_json({"type": "auth", "access_token": self.ha_token})
+			obj = await self._ws_receive(ws)
+			if obj.get("type") != "auth_ok":
+				raise ConnectionError(f"HA websocket: authentication failed: {obj!r}")
+			# A state trigger fires on every state_changed event of the
+			# listed entities, filtered on the HA side.
+			await ws.send_json({
+				"id": 1,
+				"type": "subscribe_trigger",
+				"trigger": {
+					"platform": "state",
+					"entity_id": [f"sensor.{o}" for o in self.sensor_watches],
+				},
+			})
+			obj = await self._ws_receive(ws)
+			if not obj.get("success", False):
+				raise ConnectionError(f"HA websocket: subscription failed: {obj!r}")
+			self.ws_connected = True
+			info("HA websocket: Subscribed to sensor state changes")
+			# Catch up on what changed while we were not subscribed
+			await self._refresh_watched_sensors()
+			while True:
+				obj = await self._ws_receive(ws)
+				if obj.get("type") != "event":
+					continue
+				try:
+					trigger = obj["event"]["variables"]["trigger"]
+					objid = trigger["entity_id"].removeprefix("sensor.")
+					handler = self.sensor_watches[objid]
+				except (KeyError, TypeError, AttributeError):
+					continue
+				self.ws_events += 1
+				handler(*self._parse_sensor_state(objid, trigger.get("to_state", None)))
+
+	async def sensor_state_subscriber(self):
+		while True:
+			try:
+				await self._ws_session()
+			except (aiohttp.ClientError, ConnectionError, asyncio.TimeoutError, ValueError) as e:
+				warning(f"HA websocket: {e!r}")
+			self.ws_connected = False
+			try:
+				# Keep sensors updated over REST until the websocket is back
+				await self._refresh_watched_sensors()
+			except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+				warning(f"HA REST refresh: {e!r}")
+			await asyncio.sleep(self.WEBSOCKET_RETRY)
@@ -39,6 +39,9 @@ class SensorData:
 	def get_value(self):
 		return self.state
 
+	def get_online_value(self):
+		return self.state if self.online else None
+
 @dataclass
 class Sensors:
 	power_cv: SensorData = dfield(SensorData("CV mains power", "intergas_power"))
@@ -56,6 +59,43 @@ class Sensors:
 	setpoint_tpo: SensorData = dfield(SensorData("Pricom Setoint"))
 	setpoint_aux: SensorData = dfield(SensorData("Zolder Setoint"))
 
+@dataclass
+class SourceStats:
+	name: str
+	period: float
+	deadline: float
+	runs: int = 0
+	overruns: int = 0
+	failures: int = 0
+	duration: float = 0.0
+	max_duration: float = 0.0
+	ts: float = 0.0
+
+	def age(self):
+		return time() - self.ts
+
+	def update(self, duration, ok):
+		"""
+		ok is None for push sources, which set ts themselves on every update.
+		"""
+		self.runs += 1
+		self.duration = duration
+		self.max_duration = max(self.max_duration, duration)
+		if duration > self.deadline:
+			self.overruns += 1
+			warning(f"Acquisition {self.name}: took {duration:.3f}s, deadline {self.deadline:.3f}s")
+		if ok:
+			self.ts = time()
+		elif ok is not None:
+			self.failures += 1
+
+@dataclass
+class Sources:
+	adc: SourceStats = dfield(SourceStats("Coolant temperature ADC", 1.0, 0.2))
+	counters: SourceStats = dfield(SourceStats("Coolant flow counter", 1.0, 0.1))
+	serial: SourceStats = dfield(SourceStats("Pricom serial", 1.0, 0.1))
+	ha: SourceStats = dfield(SourceStats("Home Assistant", 1.0, 0.1))
+
 class MinerStates(Enum):
 	OFF = 0
 	STARTING = 1
@@ -140,8 +180,15 @@ class Controller:
 		self.freq0 = base_io.Frequency(counter0)
 		self.freq1 = base_io.Frequency(counter1)
 		adcpath = "/sys/bus/iio/devices/iio:device1/"
-		self.temp_in = base_io.Temperature(base_io.IioAdc(adcpath, 2), R25=50000, BETA=3850)
-		self.temp_out = base_io.Temperature(base_io.IioAdc(adcpath, 3), R25=10000, BETA=4050)
+		try:
+			self.adcbuf = base_io.IioBufferedAdc(adcpath, (2, 3))
+			adc_in, adc_out = self.adcbuf.channel(2), self.adcbuf.channel(3)
+			info("Coolant temperature ADC in buffered mode")
+		except (OSError, ValueError) as e:
+			warning(f"Buffered IIO not available ({e}), reading single samples")
+			adc_in, adc_out = base_io.IioAdc(adcpath, 2), base_io.IioAdc(adcpath, 3)
+		self.temp_in = base_io.Temperature(adc_in, R25=50000, BETA=3850)
+		self.temp_out = base_io.Temperature(adc_out, R25=10000, BETA=4050)
 		self.flow_cool = base_io.FlowRate(self.freq0, 6.6)
 		self.mqtt_sensor_temp_in = self.ha.create_temperature_sensor("sensor_temp_in", "Coolant inlet temperature")
 		self.mqtt_sensor_temp_out = self.ha.create_temperature_sensor("sensor_temp_out", "Coolant outlet temperature")
@@ -156,6 +203,11 @@ class Controller:
 		self.mqtt_number_setp_aux.add_handler(self.mqtt_handle_number_setp_aux)
 		self.ha.subscribe("wmpower/deadbeef/whatsminer/SENSOR", self.handle_mqtt_power_wm)
 		self.sensors = Sensors()
+		self.sources = Sources()
+		for s in self.sensors.__dict__:
+			sensor = getattr(self.sensors, s)
+			if sensor.ha_objid is not None:
+				self.ha.watch_sensor(sensor.ha_objid, self._ha_sensor_handler(sensor))
 		self.need_cooling = False
 		self.want_main_heat = False
 		self.want_aux_heat = False
@@ -179,6 +231,7 @@ class Controller:
 		self.pricom_amb_light = self.sj.get_sensor("AmbientLight")
 		self.pricom_temp_sp = self.sj.get_sensor("TempSetpoint", 0.1)
 		self.webserver = Server(self)
+		self.tasks = set()
 
 	def set_manual_override(self, val):
 		if val and not self.manual_override:
@@ -228,6 +281,16 @@ class Controller:
 			sensor.online = True
 			debug(f"SENSOR: {sensor.name} state {state} age {sensor.age()} seconds")
 
+	def _ha_sensor_handler(self, sensor):
+		def handler(state, ts):
+			if state is None:
+				sensor.online = False
+			elif ts >= sensor.ts:
+				# A REST refresh may return an older state than a pushed one
+				self._setsens(sensor, state, ts)
+				self.sources.ha.ts = time()
+		return handler
+
 	def handle_mqtt_power_wm(self, obj):
 		debug(f"Got MQTT power WM:{obj!r}")
 		if "Power" in obj:
@@ -375,36 +438,76 @@ class Controller:
 				nudges += 1
 				info(f"Valve steering nudge AUX. Nudges = {nudges}, dt = {dt}")
 
-	async def sensor_updater(self):
-		vps = [
-			ValuePacer(self.temp_in.get_value, self.mqtt_sensor_temp_in.mqtt_value, 2, 120, 0.2, 10),
-			ValuePacer(self.temp_out.get_value, self.mqtt_sensor_temp_out.mqtt_value, 2, 120, 0.2, 10),
-			ValuePacer(self.pricom_temp.get_value, self.mqtt_sensor_temp_tpo.mqtt_value, 2, 50, 0.2, 10),
-			ValuePacer(self.flow_cool.get_value, self.mqtt_sensor_flow_cool.mqtt_value, 0, 50, 0.2, 10),
-			ValuePacer(self.pricom_temp_sp.get_value, self.mqtt_sensor_setp_tpo.mqtt_value, 2, 50, 0.2, 10),
-			ValuePacer(self.pricom_rh.get_value, self.mqtt_sensor_humidity_tpo.mqtt_value, 1, 100, 1, 10),
-			ValuePacer(self.pricom_amb_light.get_value, self.mqtt_sensor_illuminance_tpo.mqtt_value, 0, 10000, 5, 10),
-			ValuePacer(self.pricom_pressure.get_value, self.mqtt_sensor_pressure_tpo.mqtt_value, 500, 2000, 2, 10),
-			ValuePacer(self.pricom_co2.get_value, self.mqtt_sensor_co2_tpo.mqtt_value, 300, 10000, 50, 10),
-			ValuePacer(self.sensors.setpoint_aux.get_value, self.mqtt_number_setp_aux.mqtt_value, 2, 40, 0.2, 10),
-		]
-		while True:
-			await asyncio.sleep(1)
-			for vp in vps:
-				vp.handle()
-			for s in self.sensors.__dict__:
-				sensor = getattr(self.sensors, s)
-				if sensor.ha_objid is not None:
-					state, ts = await self.ha.get_sensor_state_and_timestamp(sensor.ha_objid)
-					if state is not None:
-						self._setsens(sensor, state, ts)
+	async def acquire(self, stats, reads, pacers):
+		"""
+		Acquisition loop of one sensor source. Every source runs in its own
+		task, so a slow source never delays the others. A read that raises
+		takes its sensor offline, the error is logged once until it recovers.
+		"""
+		failing = set()
+		def report(name, e):
+			if e is None:
+				if name in failing:
+					failing.discard(name)
+					info(f"Acquisition {stats.name}: {name} recovered")
+			elif name not in failing:
+				failing.add(name)
+				error(f"Acquisition {stats.name}: {name} failed: {e!r}")
+		try:
+			while True:
+				t0 = monotonic()
+				ok = True
+				for sensor, readfunc in reads:
+					try:
+						val = readfunc()
+					except Exception as e:
+						report(sensor.name, e)
+						val = None
+					else:
+						report(sensor.name, None)
+					if val is None:
+						ok = False
+					self._setsens(sensor, val)
+				for i, vp in enumerate(pacers):
+					try:
+						vp.handle()
+					except Exception as e:
+						report(f"pacer {i}", e)
 					else:
-						sensor.online = False
-			self._setsens(self.sensors.flowrate_cool, self.flow_cool.get_value())
-			self._setsens(self.sensors.temp_in, self.temp_in.get_value())
-			self._setsens(self.sensors.temp_out, self.temp_out.get_value())
-			self._setsens(self.sensors.temp_tpo, self.pricom_temp.get_value())
-			self._setsens(self.sensors.setpoint_tpo, self.pricom_temp_sp.get_value())
+						report(f"pacer {i}", None)
+				dt = monotonic() - t0
+				# Push sources (HA) have no reads to fail
+				stats.update(dt, ok if reads else None)
+				await asyncio.sleep(max(0, stats.period - dt))
+		finally:
+			# Never leave stale values behind if this task ends
+			for sensor, readfunc in reads:
+				sensor.online = False
+
+	def sensor_tasks(self):
+		s = self.sensors
+		src = self.sources
+		return [
+			self.acquire(src.adc, [(s.temp_in, self.temp_in.get_value), (s.temp_out, self.temp_out.get_value)], [
+				ValuePacer(s.temp_in.get_online_value, self.mqtt_sensor_temp_in.mqtt_value, 2, 120, 0.2, 10),
+				ValuePacer(s.temp_out.get_online_value, self.mqtt_sensor_temp_out.mqtt_value, 2, 120, 0.2, 10),
+			]),
+			self.acquire(src.counters, [(s.flowrate_cool, self.flow_cool.get_value)], [
+				ValuePacer(s.flowrate_cool.get_online_value, self.mqtt_sensor_flow_cool.mqtt_value, 0, 50, 0.2, 10),
+			]),
+			self.acquire(src.serial, [(s.temp_tpo, self.pricom_temp.get_value), (s.setpoint_tpo, self.pricom_temp_sp.get_value)], [
+				ValuePacer(s.temp_tpo.get_online_value, self.mqtt_sensor_temp_tpo.mqtt_value, 2, 50, 0.2, 10),
+				ValuePacer(s.setpoint_tpo.get_online_value, self.mqtt_sensor_setp_tpo.mqtt_value, 2, 50, 0.2, 10),
+				ValuePacer(self.pricom_rh.get_value, self.mqtt_sensor_humidity_tpo.mqtt_value, 1, 100, 1, 10),
+				ValuePacer(self.pricom_amb_light.get_value, self.mqtt_sensor_illuminance_tpo.mqtt_value, 0, 10000, 5, 10),
+				ValuePacer(self.pricom_pressure.get_value, self.mqtt_sensor_pressure_tpo.mqtt_value, 500, 2000, 2, 10),
+				ValuePacer(self.pricom_co2.get_value, self.mqtt_sensor_co2_tpo.mqtt_value, 300, 10000, 50, 10),
+			]),
+			# HA sensors are pushed, only pace the setpoint back to HA
+			self.acquire(src.ha, [], [
+				ValuePacer(s.setpoint_aux.get_online_value, self.mqtt_number_setp_aux.mqtt_value, 2, 40, 0.2, 10),
+			]),
+		]
 
 	def get_any_power(self):
 		s = self.sensors
@@ -418,18 +521,27 @@ class Controller:
 			return s.power_wmp.state
 
 	def get_highest_temp(self):
+		"""
+		Highest of the online coolant and miner temperatures. An offline
+		sensor keeps its last state, which must not be trusted.
+		"""
+		s = self.sensors
+		return max([x.state for x in (s.temp_in, s.temp_out, s.temp_wm) if x.online] or [0.0])
+
+	def coolant_temp_known(self):
 		s = self.sensors
-		return max(s.temp_in.state, s.temp_out.state, s.temp_wm.state)
+		return s.temp_in.online or s.temp_out.online
 
 	def get_best_miner_temp(self):
 		s = self.sensors
 		temp = s.temp_wm.state
-		if s.temp_wm.age_online() < 15.0 and temp > 15.0:
+		# wmpower publishes on change (deadband) or at least every 30 seconds
+		if s.temp_wm.age_online() < 45.0 and temp > 15.0:
 			return temp
 		temp = s.temp_out.state
 		if s.temp_out.age_online() < 20.0 and temp > 15.0:
 			return temp
-		return max(s.temp_in.state, s.temp_out.state, s.temp_wm.state)
+		return self.get_highest_temp()
 
 	def dump_heat(self, nc, wmh, wah, cvpw, cda):
 		if cvpw and cda:
@@ -468,6 +580,7 @@ class Controller:
 			else:
 				await self.set_valve_aux_circuit()
 		fants = monotonic()
+		coolant_known0 = True
 		while True:
 			await asyncio.sleep(3.1415)
 			# 1. Check if something needs cooling:
@@ -544,6 +657,17 @@ class Controller:
 				self.commanded_state = MinerStates.IDLE
 				miner_ok = False
 
+			# Without any coolant temperature, idle until a sensor is back.
+			coolant_known = self.coolant_temp_known()
+			if coolant_known != coolant_known0:
+				if coolant_known:
+					info("Coolant temperature back online")
+				else:
+					warning("No coolant temperature online! Idling miner...")
+				coolant_known0 = coolant_known
+			if not coolant_known and self.state in (MinerStates.STARTING, MinerStates.RUNNING):
+				self.commanded_state = MinerStates.IDLE
+
 			# 7. Check for emergency shutdown limit:
 			if t > self.TEMP_LIMIT_EMERGENCY:
 				warning(f"Highest temperature is {t} °C! Performing emergency shutdown...")
@@ -554,9 +678,9 @@ class Controller:
 			# 8. Check if we need to start the miner. Wait for hot water demand to
 			# stop if it is active.
 			if (self.want_main_heat or self.want_aux_heat) and self.can_cool and not self.cv_power_water():
-				if miner_ok:
+				if miner_ok and coolant_known:
 					self.commanded_state = MinerStates.RUNNING
-				elif self.miner_ok:
+				elif self.miner_ok and not miner_ok:
 					# Old state was ok, new state not ok, complain once.
 					warning("Want miner heat, but miner not Ok.")
 
@@ -649,7 +773,9 @@ class Controller:
 			await asyncio.sleep(1)
 			#if not s.setpoint_tpo.online:
 			#	continue
-			if not s.temp_tpo.online or not s.temp_zone1.online:
+			# Pricom temperature goes offline when its field stops arriving,
+			# temp_zone0 is the fallback.
+			if not (s.temp_tpo.online or s.temp_zone0.online) or not s.temp_zone1.online:
 				continue
 			if not s.power_cv.online:
 				continue
@@ -657,14 +783,17 @@ class Controller:
 			#	continue
 			break
 		hyst = 1.0
+		sens_main = None
 		while True:
 			await asyncio.sleep(4)
 			if s.temp_tpo.online:
 				sens_main = s.temp_tpo
 			else:
+				if sens_main is not s.temp_zone0:
+					warning(f"{s.temp_tpo.name} is stale, using {s.temp_zone0.name}")
 				sens_main = s.temp_zone0
 			sp = s.setpoint_tpo.state
-			if sp < 16:
+			if sp < 16 or not s.setpoint_tpo.online:
 				sp = 18 # TPO probably offline
 			spaux = self.setpoint_aux
 			spcv = sp - self.DELTA_TEMP_CV
@@ -777,7 +906,7 @@ class Controller:
 					continue
 				if not self.sensors.temp_zone1.online:
 					continue
-				if not self.sensors.temp_tpo.online:
+				if not (self.sensors.temp_tpo.online or self.sensors.temp_zone0.online):
 					continue
 				if not self.sensors.power_pv.online:
 					continue
@@ -847,17 +976,41 @@ class Controller:
 				# Don't make a new decision for the next 30 minutes.
 				await asyncio.sleep(30 * 60)
 
+	def _task_done(self, task):
+		self.tasks.discard(task)
+		if task.cancelled():
+			return
+		e = task.exception()
+		if e is not None:
+			error(f"Task {task.get_name()} died: {e!r}", exc_info=e)
+		else:
+			error(f"Task {task.get_name()} ended")
+
+	def start_task(self, coro):
+		"""
+		Run a control or acquisition loop. These never return, so the end of
+		one is logged as an error.
+		"""
+		task = asyncio.create_task(coro, name=coro.__name__)
+		self.tasks.add(task)
+		task.add_done_callback(self._task_done)
+		return task
+
 	async def run(self):
 		await self.webserver.startup()
-		asyncio.create_task(self.sensor_updater())
-		asyncio.create_task(self.miner_control_loop())
-		asyncio.create_task(self.miner_power_loop())
-		asyncio.create_task(self.ambient_control_loop())
-		asyncio.create_task(self.cv_heat_control_loop())
-		asyncio.create_task(self.aux_main_toggle_loop())
-		asyncio.create_task(self.track_cv_power_loop())
-		asyncio.create_task(self.valve_middle_steering())
-		await self.ha.run()
+		for t in self.sensor_tasks():
+			self.start_task(t)
+		self.start_task(self.miner_control_loop())
+		self.start_task(self.miner_power_loop())
+		self.start_task(self.ambient_control_loop())
+		self.start_task(self.cv_heat_control_loop())
+		self.start_task(self.aux_main_toggle_loop())
+		self.start_task(self.track_cv_power_loop())
+		self.start_task(self.valve_middle_steering())
+		try:
+			await self.ha.run()
+		finally:
+			await self.ha.restapi_close()
 
 def main(args):
 	"""
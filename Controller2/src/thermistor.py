@@ -0,0 +1,49 @@
+# NTC thermistor conversion, shared by Controller2 and the Pico Controller.
+# Keep this MicroPython compatible.
+
+import math
+from array import array
+
+def adc2celsius(adc, R25=50000, BETA=3950):
+	if adc <= 1:
+		return 0
+	R1 = 100000
+	Rt = 65535 / adc - 1
+	if Rt <= 0:
+		return 0
+	v = math.log(R1 / Rt / R25) / BETA + 1.0 / 298.15
+	if v == 0:
+		return 0
+	return 1 / v - 273.15
+
+class ThermistorTable:
+	"""
+	Precomputed adc2celsius() for one (R25, BETA) with linear interpolation
+	between entries every 2**step_bits ADC counts. With the default of 32
+	counts the error stays below 0.05 degree between 0 and 100 degrees for
+	the 10k and 50k thermistors used here.
+	"""
+	def __init__(self, R25=50000, BETA=3950, step_bits=5):
+		self.R25 = R25
+		self.BETA = BETA
+		self.step = 1 << step_bits
+		n = (65536 >> step_bits) + 1
+		self.table = array("f", [adc2celsius(min(i * self.step, 65534), R25, BETA) for i in range(n)])
+		self.last = n - 1
+
+	def convert(self, adc):
+		if adc <= 1:
+			return 0
+		pos = adc / self.step
+		i = int(pos)
+		if i >= self.last:
+			return self.table[self.last]
+		t0 = self.table[i]
+		return t0 + (self.table[i + 1] - t0) * (pos - i)
+
+	def convert_many(self, values):
+		"""
+		Convert a sequence of ADC values, returns an array of floats.
+		"""
+		conv = self.convert
+		return array("f", [conv(v) for v in values])
@@ -0,0 +1,120 @@
+import os
+import pty
+import sys
+import asyncio
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import base_io
+import main
+
+class TestAmbientFallback(unittest.IsolatedAsyncioTestCase):
+	"""
+	ambient_control_loop falls back to temp_zone0 when the Pricom
+	temperature goes stale.
+	"""
+	async def asyncSetUp(self):
+		self.master, slave = pty.openpty()
+		self.sj = base_io.SerialJSON(os.ttyname(slave), 115200)
+		os.close(slave)
+		# Only the state ambient_control_loop uses, no hardware
+		c = main.Controller.__new__(main.Controller)
+		c.sensors = main.Sensors()
+		c.setpoint_aux = 16.0
+		c.want_main_heat = False
+		c.want_aux_heat = False
+		c.want_cv_heat = False
+		c.cv_heat_allowed = False
+		c.is_night_time = lambda: False
+		s = c.sensors
+		c._setsens(s.setpoint_tpo, 20.0)
+		c._setsens(s.temp_zone0, 15.0)
+		c._setsens(s.temp_zone1, 18.0)
+		c._setsens(s.power_cv, 0.0)
+		self.c = c
+
+	async def asyncTearDown(self):
+		self.sj.s.close()
+		os.close(self.master)
+
+	async def run_loop(self, c, cycles=3):
+		sleep = asyncio.sleep
+		async def fast_sleep(t):
+			await sleep(0)
+		with mock.patch.object(main.asyncio, "sleep", fast_sleep):
+			task = asyncio.create_task(c.ambient_control_loop())
+			for i in range(cycles):
+				await sleep(0)
+			task.cancel()
+			await asyncio.gather(task, return_exceptions=True)
+
+	async def test_fallback_on_stale_pricom(self):
+		c = self.c
+		s = c.sensors
+		pricom_temp = self.sj.get_sensor("Temperature", 0.1)
+		with mock.patch.object(base_io, "monotonic", return_value=1000.0) as t:
+			self.sj.feed(b'{"Temperature": 225}\n')
+			c._setsens(s.temp_tpo, pricom_temp.get_value())
+			await self.run_loop(c)
+			self.assertAlmostEqual(c.best_main_temp, 22.5)
+			self.assertFalse(c.want_main_heat)
+
+			# No Temperature for longer than max_age
+			t.return_value = 1000.0 + self.sj.max_age + 1
+			c._setsens(s.temp_tpo, pricom_temp.get_value())
+			self.assertFalse(s.temp_tpo.online)
+			await self.run_loop(c)
+			self.assertEqual(c.best_main_temp, 15.0)
+			self.assertTrue(c.want_main_heat)
+
+	async def test_stale_setpoint(self):
+		c = self.c
+		s = c.sensors
+		c._setsens(s.temp_tpo, 19.0)
+		await self.run_loop(c)
+		self.assertEqual(c.setpoint_main, 20.0)
+		s.setpoint_tpo.online = False
+		await self.run_loop(c)
+		self.assertEqual(c.setpoint_main, 18)
+
+class TestAcquire(unittest.IsolatedAsyncioTestCase):
+	async def run_acquire(self, stats, reads, pacers, cycles=3):
+		c = main.Controller.__new__(main.Controller)
+		sleep = asyncio.sleep
+		async def fast_sleep(t):
+			await sleep(0)
+		with mock.patch.object(main.asyncio, "sleep", fast_sleep):
+			task = asyncio.create_task(c.acquire(stats, reads, pacers))
+			for i in range(cycles):
+				await sleep(0)
+			task.cancel()
+			await asyncio.gather(task, return_exceptions=True)
+
+	async def test_push_source_no_failures(self):
+		stats = main.SourceStats("push", 1.0, 0.1)
+		await self.run_acquire(stats, [], [])
+		self.assertGreater(stats.runs, 0)
+		self.assertEqual(stats.failures, 0)
+
+	async def test_offline_sensor_not_republished(self):
+		stats = main.SourceStats("pull", 1.0, 0.1)
+		sensor = main.SensorData("test")
+		values = [20.0]
+		def read():
+			return values.pop(0)
+		published = []
+		with mock.patch.object(main, "monotonic", return_value=1000.0) as t:
+			pacer = main.ValuePacer(sensor.get_online_value, published.append, 2, 50, 0.2, 10)
+			await self.run_acquire(stats, [(sensor, read)], [pacer], cycles=1)
+			self.assertEqual(published, [20.0])
+			# The read now raises, the last value must not be paced out again
+			t.return_value = 1100.0
+			await self.run_acquire(stats, [(sensor, read)], [pacer])
+		self.assertFalse(sensor.online)
+		self.assertEqual(published, [20.0])
+		self.assertGreater(stats.failures, 0)
+
+if __name__ == "__main__":
+	unittest.main()
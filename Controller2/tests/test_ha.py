@@ -0,0 +1,53 @@
+import os
+import sys
+import asyncio
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import ha
+
+class TestUnauthorized(unittest.IsolatedAsyncioTestCase):
+	"""
+	HA answers every request with 401 and a text body.
+	"""
+	async def asyncSetUp(self):
+		self.requests = 0
+		async def handle(request):
+			self.requests += 1
+			return web.Response(status=401, text="401: Unauthorized")
+		app = web.Application()
+		app.router.add_get("/{tail:.*}", handle)
+		self.runner = web.AppRunner(app)
+		await self.runner.setup()
+		site = web.TCPSite(self.runner, "127.0.0.1", 0)
+		await site.start()
+		port = self.runner.addresses[0][1]
+		self.ha = ha.HomeAssistant("127.0.0.1", "user", None)
+		self.ha.session = aiohttp.ClientSession(f"http://127.0.0.1:{port}")
+		self.ha.WEBSOCKET_RETRY = 0.01
+		self.updates = []
+		self.ha.watch_sensor("test", lambda state, ts: self.updates.append(state))
+
+	async def asyncTearDown(self):
+		await self.ha.restapi_close()
+		await self.runner.cleanup()
+
+	async def test_restapi_get(self):
+		self.assertIsNone(await self.ha.restapi_get("states/sensor.test"))
+
+	async def test_subscriber_keeps_running(self):
+		task = self.ha.start_task(self.ha.sensor_state_subscriber())
+		await asyncio.sleep(0.3)
+		self.assertFalse(task.done())
+		task.cancel()
+		await asyncio.gather(task, return_exceptions=True)
+		self.assertGreater(len(self.updates), 1)
+		self.assertEqual(set(self.updates), {None})
+		self.assertFalse(self.ha.tasks)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,121 @@
+import os
+import pty
+import sys
+import asyncio
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import base_io
+
+class PtyTestCase(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.master, slave = pty.openpty()
+		self.slavename = os.ttyname(slave)
+		os.close(slave)
+		self.sj = base_io.SerialJSON(self.slavename, 115200)
+
+	async def asyncTearDown(self):
+		if self.sj.transport is not None:
+			self.sj.transport.close()
+			await asyncio.sleep(0)
+		self.sj.s.close()
+		os.close(self.master)
+
+	async def wait_frames(self, n, timeout=2.0):
+		t_end = asyncio.get_running_loop().time() + timeout
+		while self.sj.frames + self.sj.bad_frames < n:
+			if asyncio.get_running_loop().time() > t_end:
+				self.fail(f"only {self.sj.frames} good and {self.sj.bad_frames} bad frames")
+			await asyncio.sleep(0.01)
+
+BURST = (b'{"Temperature": 215, "RH": 456}\n'
+	b'{"CO2": 612}\r\n'
+	b'not json\n'
+	b'[1, 2]\n'
+	b'\n'
+	+ b'x' * (base_io.SerialJSON.MAX_BUFFER + 100)
+	+ b'{"Temperature": 999}\n'
+	b'{"Temperature": 220}\n')
+
+class TestSerialJSONReader(PtyTestCase):
+	async def test_one_transport_per_tick(self):
+		with mock.patch.object(base_io.serial_asyncio, "SerialTransport",
+				wraps=base_io.serial_asyncio.SerialTransport) as transport:
+			sensors = [self.sj.get_sensor(f) for f in ("Temperature", "RH", "CO2")]
+			for s in sensors:
+				self.assertIsNone(s.get_value())
+			await asyncio.sleep(0)
+			for s in sensors:
+				s.get_value()
+			self.assertEqual(transport.call_count, 1)
+
+	async def test_burst(self):
+		self.sj.ensure_reader()
+		os.write(self.master, BURST)
+		await self.wait_frames(6)
+		# The overlong line, with the frame glued to its end, is dropped
+		self.assertEqual(self.sj.frames, 3)
+		self.assertEqual(self.sj.overflows, 1)
+		self.assertEqual(self.sj.bad_frames, 3)
+		self.assertAlmostEqual(self.sj.get_value("Temperature", 0.1), 22.0)
+		self.assertAlmostEqual(self.sj.get_value("RH", 0.1), 45.6)
+		self.assertEqual(self.sj.get_value("CO2"), 612)
+		self.assertEqual(self.sj.fields["Temperature"][2], 2)
+
+	async def test_line_split_across_reads(self):
+		self.sj.ensure_reader()
+		os.write(self.master, b'{"Pressure": 10')
+		await asyncio.sleep(0.05)
+		self.assertIsNone(self.sj.get_value("Pressure"))
+		os.write(self.master, b'13}\n')
+		await self.wait_frames(1)
+		self.assertEqual(self.sj.get_value("Pressure"), 1013)
+
+class TestSerialJSONFeed(PtyTestCase):
+	async def test_chunking(self):
+		# Same result no matter how the reads split the burst
+		for size in (1, 7, 1024, len(BURST)):
+			sj = base_io.SerialJSON(self.slavename, 115200)
+			for i in range(0, len(BURST), size):
+				sj.feed(BURST[i:i + size])
+			self.assertEqual((sj.frames, sj.bad_frames, sj.overflows), (3, 3, 1), size)
+			self.assertEqual(sj.fields["Temperature"][0], 220)
+			self.assertEqual(len(sj.rbuf), 0)
+			sj.s.close()
+
+	async def test_non_numeric(self):
+		self.sj.feed(b'{"A": null, "B": "12", "C": true, "D": 1.5}\n')
+		for f in ("A", "B", "C"):
+			self.assertIsNone(self.sj.get_value(f))
+		self.assertEqual(self.sj.get_value("D", 2), 3.0)
+
+class TestSerialJSONFreshness(PtyTestCase):
+	async def test_max_age(self):
+		with mock.patch.object(base_io, "monotonic", return_value=1000.0) as t:
+			self.sj.feed(b'{"Temperature": 215}\n')
+			sensor = self.sj.get_sensor("Temperature", 0.1)
+			short = self.sj.get_sensor("Temperature", 0.1, max_age=5)
+			t.return_value = 1029.0
+			self.assertAlmostEqual(sensor.get_value(), 21.5)
+			self.assertIsNone(short.get_value())
+			self.assertEqual(sensor.age(), 29.0)
+			t.return_value = 1031.0
+			self.assertIsNone(sensor.get_value())
+			self.sj.feed(b'{"Temperature": 216}\n')
+			self.assertAlmostEqual(sensor.get_value(), 21.6)
+
+	async def test_rate(self):
+		with mock.patch.object(base_io, "monotonic", return_value=1000.0) as t:
+			self.sj.feed(b'{"CO2": 600}\n')
+			self.assertIsNone(self.sj.field_stats()["CO2"]["rate"])
+			for i in range(1, 4):
+				t.return_value = 1000.0 + 2 * i
+				self.sj.feed(b'{"CO2": 600}\n')
+			stats = self.sj.field_stats()["CO2"]
+			self.assertEqual(stats["count"], 4)
+			self.assertAlmostEqual(stats["rate"], 0.5)
+
+if __name__ == "__main__":
+	unittest.main()
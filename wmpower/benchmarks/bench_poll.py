@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+# Benchmark of the wmpower poll path against simulated miners (wmsim.py).
+#
+# Measures latency and throughput of the sync and asyncio API calls and
+# breaks the time down into connect, crypto, JSON parse and publish. Results
+# are written as JSON, so runs before and after a change can be compared with
+# -b.
+
+import os
+import sys
+import json
+import socket
+import inspect
+import asyncio
+import platform
+import subprocess
+from time import time, perf_counter
+
+WMPOWER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WMPOWER_DIR)
+
+import gmqtt
+from gmqtt.mqtt.constants import MQTTv50
+from gmqtt.mqtt.package import PublishPacket
+from whatsminer import api, aio, write_key_cache, WhatsminerAccessToken, WhatsminerAPI
+from wmpower import Whatsminer
+
+class PhaseTimer:
+	"""
+	Accumulates the time spent in instrumented functions.
+	"""
+	def __init__(self):
+		self.phases = {}
+
+	def reset(self):
+		self.phases = {}
+
+	def add(self, phase, dt):
+		n, total = self.phases.get(phase, (0, 0.0))
+		self.phases[phase] = (n + 1, total + dt)
+
+	def wrap(self, phase, f):
+		def timed(*args, **kw):
+			t0 = perf_counter()
+			try:
+				return f(*args, **kw)
+			finally:
+				self.add(phase, perf_counter() - t0)
+		return timed
+
+	def wrap_async(self, phase, f):
+		async def timed(*args, **kw):
+			t0 = perf_counter()
+			try:
+				return await f(*args, **kw)
+			finally:
+				self.add(phase, perf_counter() - t0)
+		return timed
+
+	def result(self):
+		return {k: {"count": n, "total_ms": total * 1000, "mean_ms": total * 1000 / n}
+				for k, (n, total) in sorted(self.phases.items())}
+
+timer = PhaseTimer()
+
+def instrument():
+	"""
+	Wrap the functions of each phase. Everything else is network and
+	simulator time.
+	"""
+	api.WhatsminerConnection._connect = timer.wrap("connect", api.WhatsminerConnection._connect)
+	aio.AsyncWhatsminerConnection._connect = timer.wrap_async("connect", aio.AsyncWhatsminerConnection._connect)
+	api.crypt = timer.wrap("md5_crypt", api.crypt)
+	WhatsminerAccessToken.encrypt_frame = timer.wrap("aes", WhatsminerAccessToken.encrypt_frame)
+	WhatsminerAccessToken.decrypt_frame = timer.wrap("aes", WhatsminerAccessToken.decrypt_frame)
+	parse = WhatsminerAPI._parse_read_only.__func__
+	WhatsminerAPI._parse_read_only = classmethod(timer.wrap("json_parse", parse))
+
+class PublishProtocol:
+	proto_ver = MQTTv50
+
+def publish(topic, values):
+	"""
+	Everything gmqtt does for a publish before the packet hits the socket.
+	QoS 0, so no packet id has to be allocated without a connection.
+	"""
+	t0 = perf_counter()
+	msg = gmqtt.Message(topic, values, qos=0, content_type='json')
+	PublishPacket.build_package(msg, PublishProtocol)
+	timer.add("publish", perf_counter() - t0)
+
+def percentile(sorted_values, p):
+	if not sorted_values:
+		return 0.0
+	i = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+	return sorted_values[i]
+
+def summarize(latencies, total, errors):
+	lat = sorted(latencies)
+	n = len(lat)
+	return {
+		"count": n,
+		"errors": errors,
+		"total_s": total,
+		"throughput_per_s": n / total if total > 0 else 0.0,
+		"latency_ms": {
+			"mean": sum(lat) * 1000 / n if n else 0.0,
+			"p50": percentile(lat, 50) * 1000,
+			"p95": percentile(lat, 95) * 1000,
+			"max": lat[-1] * 1000 if n else 0.0,
+		},
+		"phases": timer.result(),
+	}
+
+def bench_sync(name, f, n):
+	timer.reset()
+	latencies = []
+	errors = 0
+	t_start = perf_counter()
+	for i in range(n):
+		t0 = perf_counter()
+		try:
+			f()
+		except Exception as e:
+			errors += 1
+			print(f"{name}: {e!r}", file=sys.stderr)
+			continue
+		latencies.append(perf_counter() - t0)
+	return summarize(latencies, perf_counter() - t_start, errors)
+
+def bench_handshake(host, passwd, n, cached):
+	"""
+	New token with write access: connect, get_token, md5_crypt, AES setup.
+	"""
+	def f():
+		if not cached:
+			write_key_cache.clear()
+		t = WhatsminerAccessToken(ip_address=host[0], port=host[1], admin_password=passwd)
+		t.close()
+	return bench_sync("handshake", f, n)
+
+def poll_values(wm, snap):
+	"""
+	Same values as HAMiner.poll_stats().
+	"""
+	vin, iin, pin, fs = wm.parse_psu_stats(snap.get("get_psu", None))
+	voltage, fanin, fanout, freq, hr, temp = wm.parse_summary_stats(snap.get("summary", None))
+	return {
+		"VoltageIn": vin,
+		"CurrentIn": iin,
+		"Power": pin,
+		"PSUFanSpeed": fs,
+		"InputFanSpeed": fanin,
+		"OuputFanSpeed": fanout,
+		"VoltageChip": voltage,
+		"Frequency": freq,
+		"HashRate": hr,
+		"Temperature": temp
+	}
+
+async def bench_fleet(hosts, passwd, rounds):
+	"""
+	One HAMiner style poll and SENSOR publish of every miner per round,
+	all miners concurrently.
+	"""
+	timer.reset()
+	miners = [Whatsminer(f"{h}:{p}", passwd) for h, p in hosts]
+	latencies = []
+	errors = 0
+
+	async def poll(wm):
+		nonlocal errors
+		t0 = perf_counter()
+		try:
+			snap = await wm.async_poll(["summary", "edevs", "get_psu"])
+		except Exception as e:
+			errors += 1
+			wm.set_offline()
+			print(f"fleet poll: {e!r}", file=sys.stderr)
+			return
+		if snap["errors"]:
+			errors += 1
+			wm.set_offline()
+		publish(f"wmpower/{wm.host}_{wm.port}/whatsminer/SENSOR", poll_values(wm, snap))
+		latencies.append(perf_counter() - t0)
+
+	t_start = perf_counter()
+	for r in range(rounds):
+		await asyncio.gather(*[poll(wm) for wm in miners])
+	ret = summarize(latencies, perf_counter() - t_start, errors)
+	ret["miners"] = len(miners)
+	for wm in miners:
+		if wm.token is not None:
+			wm.token.close()
+	return ret
+
+def wait_for_port(host, port, timeout=10.0):
+	t_end = time() + timeout
+	while time() < t_end:
+		try:
+			socket.create_connection((host, port), timeout=1.0).close()
+			return True
+		except OSError:
+			pass
+	return False
+
+def compare(results, baseline):
+	"""
+	Print the change of mean latency relative to a previous run.
+	"""
+	for name, r in results["results"].items():
+		b = baseline.get("results", {}).get(name, None)
+		if b is None:
+			continue
+		m0 = b["latency_ms"]["mean"]
+		m1 = r["latency_ms"]["mean"]
+		if m0 > 0:
+			print(f"{name:24s} {m0:9.3f} ms -> {m1:9.3f} ms ({(m1 - m0) / m0 * 100:+6.1f}%)", file=sys.stderr)
+
+def main(args):
+	"""
+	Usage:
+		bench_poll.py [options]
+
+	Benchmark the wmpower poll path. Unless -s is given, wmsim.py is started
+	with the latency and malformed JSON options below.
+
+	Options:
+		-s <host>:<port> : Use an already running (simulated) miner
+		-P <port>        : First port for the started simulator (default 24028)
+		-n <count>       : Iterations of the single miner benchmarks (default 200)
+		-F <count>       : Number of miners for the fleet benchmark (default 20)
+		-r <rounds>      : Poll rounds of the fleet benchmark (default 20)
+		-l <seconds>     : Simulator response latency (default 0)
+		-e <fraction>    : Simulator malformed JSON fraction (default 0)
+		-p <password>    : Admin password (default "admin")
+		-o <file>        : Write results to <file> instead of stdout
+		-b <file>        : Compare mean latencies with a previous result file
+		--help           : Display this help text
+	"""
+	server = None
+	port = 24028
+	n = 200
+	fleet = 20
+	rounds = 20
+	latency = 0.0
+	malformed = 0.0
+	passwd = "admin"
+	outfile = None
+	baseline = None
+	while args:
+		a = args.pop(0)
+		if a == "-s":
+			h, p = args.pop(0).split(":")
+			server = (h, int(p))
+		elif a == "-P":
+			port = int(args.pop(0))
+		elif a == "-n":
+			n = int(args.pop(0))
+		elif a == "-F":
+			fleet = int(args.pop(0))
+		elif a == "-r":
+			rounds = int(args.pop(0))
+		elif a == "-l":
+			latency = float(args.pop(0))
+		elif a == "-e":
+			malformed = float(args.pop(0))
+		elif a == "-p":
+			passwd = args.pop(0)
+		elif a == "-o":
+			outfile = args.pop(0)
+		elif a == "-b":
+			baseline = args.pop(0)
+		elif a == "--help":
+			print(inspect.cleandoc(main.__doc__))
+			return 0
+		else:
+			print(f"Error: unknown option {a}")
+			print(inspect.cleandoc(main.__doc__))
+			return 1
+
+	sim = None
+	if server is None:
+		count = max(1, fleet)
+		sim = subprocess.Popen([sys.executable, os.path.join(WMPOWER_DIR, "wmsim.py"),
+				"-P", str(port), "-n", str(count), "-p", passwd, "-l", str(latency),
+				"-e", str(malformed), "-c", "100"], stdout=subprocess.DEVNULL)
+		hosts = [("127.0.0.1", port + i) for i in range(count)]
+		if not wait_for_port("127.0.0.1", port + count - 1):
+			sim.kill()
+			print("Error: simulator didn't start", file=sys.stderr)
+			return 1
+	else:
+		hosts = [server] * max(1, fleet)
+
+	instrument()
+	try:
+		host = hosts[0]
+		wm = Whatsminer(f"{host[0]}:{host[1]}", passwd)
+		wm.connect()
+		results = {
+			"meta": {
+				"time": time(),
+				"python": platform.python_version(),
+				"machine": platform.machine(),
+				"server": "external" if sim is None else "wmsim",
+				"latency_s": latency,
+				"malformed": malformed,
+				"iterations": n,
+			},
+			"results": {},
+		}
+		r = results["results"]
+		r["handshake_cold"] = bench_handshake(host, passwd, max(1, n // 10), False)
+		r["handshake_cached"] = bench_handshake(host, passwd, n, True)
+		r["get_summary_stats"] = bench_sync("get_summary_stats", wm.get_summary_stats, n)
+		r["get_psu_stats"] = bench_sync("get_psu_stats", wm.get_psu_stats, n)
+		r["exec_command"] = bench_sync("exec_command", lambda: wm.run_command("set_target_freq", ["0"]), n)
+		r["fleet_poll"] = asyncio.run(bench_fleet(hosts, passwd, rounds))
+		results["connections"] = {"connects": wm.token.connection.connects, "reuses": wm.token.connection.reuses}
+		wm.token.close()
+	finally:
+		if sim is not None:
+			sim.terminate()
+			sim.wait()
+
+	s = json.dumps(results, indent=4)
+	if outfile is None:
+		print(s)
+	else:
+		with open(outfile, "w") as f:
+			f.write(s + "\n")
+	if baseline is not None:
+		with open(baseline) as f:
+			compare(results, json.load(f))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
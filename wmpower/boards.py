@@ -0,0 +1,176 @@
+# Per hash board history for wmpower.
+#
+# Values from edevs are stored in fixed size ring buffers backed by the array
+# module. Every field is kept as a scaled 16 bit integer, except the cumulative
+# error count which needs 32 bits, so a sample of one board costs 12 bytes and
+# hours of history fit in a few KB per miner.
+
+from array import array
+from time import time
+
+# (name, edevs keys to try, scale, typecode)
+BOARD_FIELDS = (
+	("Temperature", ("Temperature",), 10, "h"),
+	("ChipTemp", ("Chip Temp Avg", "Chip Temp Max"), 10, "h"),
+	("Frequency", ("Chip Frequency", "Frequency"), 1, "H"),
+	("HashRate", ("MHS av",), 0.001, "H"), # Stored in GH/s
+	("Errors", ("Hardware Errors", "HW Errors"), 1, "I"), # Cumulative, passes 65535
+)
+
+# Minimum change of a field before it is published again
+BOARD_DEADBANDS = {
+	"Temperature": 0.5,
+	"ChipTemp": 0.5,
+	"Frequency": 5,
+	"HashRate": 500000, # MH/s
+	"Errors": 0,
+}
+
+class RingBuffer:
+	"""
+	Fixed size ring buffer on top of array.array. append() is O(1) and never
+	allocates after construction. Values outside the range of typecode are
+	clamped and counted in clipped, only the first one is reported.
+	"""
+	def __init__(self, length, typecode="h", name=None):
+		self.length = length
+		self.name = name
+		self.clipped = 0
+		self.data = array(typecode, bytes(length * array(typecode).itemsize))
+		self.idx = 0
+		self.count = 0
+		self.max = (1 << (8 * self.data.itemsize - (1 if typecode.islower() else 0))) - 1
+		self.min = -self.max - 1 if typecode.islower() else 0
+
+	def append(self, v):
+		if v < self.min or v > self.max:
+			self.clipped += 1
+			if self.clipped == 1:
+				print(f"RingBuffer {self.name}: value {v} out of range {self.min}..{self.max}, clamped (reported once)", flush=True)
+			v = max(self.min, min(self.max, v))
+		self.data[self.idx] = v
+		self.idx = (self.idx + 1) % self.length
+		if self.count < self.length:
+			self.count += 1
+
+	def last(self):
+		if not self.count:
+			return None
+		return self.data[self.idx - 1]
+
+	def values(self):
+		"""
+		Return the stored values, oldest first.
+		"""
+		if self.count < self.length:
+			return self.data[:self.count]
+		return self.data[self.idx:] + self.data[:self.idx]
+
+	def nbytes(self):
+		return self.length * self.data.itemsize
+
+def _get_field(dev, keys):
+	for k in keys:
+		if k in dev:
+			try:
+				return float(dev[k])
+			except (TypeError, ValueError):
+				return None
+	return None
+
+def board_id(i, dev):
+	"""
+	Board number of the i-th entry of an edevs/devdetails list.
+	"""
+	for k in ("ASC", "Slot", "ID"):
+		if k in dev:
+			return dev[k]
+	return i
+
+class BoardHistory:
+	def __init__(self, length, bid=None):
+		self.buffers = {name: RingBuffer(length, tc, f"board {bid} {name}") for name, keys, scale, tc in BOARD_FIELDS}
+		self.current = {}
+
+	def update(self, dev, record):
+		for name, keys, scale, tc in BOARD_FIELDS:
+			v = _get_field(dev, keys)
+			if v is not None:
+				self.current[name] = v
+			if record:
+				# Keep all buffers aligned with the timestamps, even if a field is missing
+				v = self.current.get(name, 0)
+				self.buffers[name].append(round(v * scale))
+
+	def history(self, name):
+		"""
+		Return the history of field name in its original unit, oldest first.
+		"""
+		scale = next(f[2] for f in BOARD_FIELDS if f[0] == name)
+		return [v / scale for v in self.buffers[name].values()]
+
+	def nbytes(self):
+		return sum(b.nbytes() for b in self.buffers.values())
+
+class BoardTracker:
+	"""
+	Track all hash boards of one miner. Every poll updates the current values,
+	history is recorded at most once per interval seconds.
+	"""
+	def __init__(self, length=360, interval=60):
+		self.length = length
+		self.interval = interval
+		self.boards = {}
+		self.details = None
+		self.timestamps = RingBuffer(length, "I", "timestamps")
+		self.t_rec = 0
+		self.published = {}
+
+	def update(self, edevs, devdetails=None, ts=None):
+		if ts is None:
+			ts = time()
+		if devdetails is not None:
+			try:
+				self.details = {str(board_id(i, d)): d for i, d in enumerate(devdetails["DEVDETAILS"])}
+			except (KeyError, TypeError):
+				pass
+		try:
+			devs = edevs["DEVS"]
+		except (KeyError, TypeError):
+			return
+		record = (ts - self.t_rec) >= self.interval
+		if record:
+			self.t_rec = ts
+			self.timestamps.append(int(ts))
+		for i, dev in enumerate(devs):
+			bid = str(board_id(i, dev))
+			b = self.boards.get(bid, None)
+			if b is None:
+				b = BoardHistory(self.length, bid)
+				self.boards[bid] = b
+			b.update(dev, record)
+
+	def _changed(self, pub, k, v, deadbands):
+		if k not in pub:
+			return True
+		return abs(v - pub[k]) > deadbands.get(k, 0)
+
+	def deltas(self, deadbands=None):
+		"""
+		Return {board: {field: value}} for all values that changed by more
+		than their deadband since they were last returned, and remember them
+		as published.
+		"""
+		if deadbands is None:
+			deadbands = {}
+		ret = {}
+		for bid, b in self.boards.items():
+			pub = self.published.setdefault(bid, {})
+			d = {k: v for k, v in b.current.items() if self._changed(pub, k, v, deadbands)}
+			if d:
+				pub.update(d)
+				ret[bid] = d
+		return ret
+
+	def nbytes(self):
+		return self.timestamps.nbytes() + sum(b.nbytes() for b in self.boards.values())
@@ -0,0 +1,172 @@
+# Prometheus/OpenMetrics text exporter for wmpower.
+#
+# Metrics are rendered from the last poll snapshot of each HAMiner, so a
+# scrape never causes any additional requests to the miners.
+
+import asyncio
+import math
+from boards import board_id
+
+POLL_DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (SENSOR field, metric name, help text)
+MINER_GAUGES = (
+	("Power", "whatsminer_power_watts", "PSU input power"),
+	("VoltageIn", "whatsminer_input_voltage_volts", "PSU input voltage"),
+	("CurrentIn", "whatsminer_input_current_amperes", "PSU input current"),
+	("HashRate", "whatsminer_hashrate_terahashes", "Average hash rate in TH/s"),
+	("Temperature", "whatsminer_temperature_celsius", "Miner temperature"),
+	("VoltageChip", "whatsminer_chip_voltage_volts", "Hash chip supply voltage"),
+	("Frequency", "whatsminer_frequency_megahertz", "Average chip frequency"),
+)
+
+FAN_FIELDS = (
+	("PSUFanSpeed", "psu"),
+	("InputFanSpeed", "in"),
+	("OuputFanSpeed", "out"),
+)
+
+# (edevs field, metric name, help text)
+BOARD_GAUGES = (
+	("Temperature", "whatsminer_board_temperature_celsius", "Hash board temperature"),
+	("Chip Temp Avg", "whatsminer_board_chip_temperature_celsius", "Average chip temperature of hash board"),
+	("MHS av", "whatsminer_board_hashrate_megahashes", "Average hash rate of hash board in MH/s"),
+)
+
+class Histogram:
+	def __init__(self, buckets):
+		self.buckets = tuple(buckets)
+		self.counts = [0] * len(self.buckets)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, v):
+		self.count += 1
+		self.sum += v
+		for i, b in enumerate(self.buckets):
+			if v <= b:
+				self.counts[i] += 1
+
+def _fmt(v):
+	if v is None:
+		return "NaN"
+	v = float(v)
+	if math.isinf(v):
+		return "+Inf" if v > 0 else "-Inf"
+	return repr(v)
+
+def _labels(**kw):
+	s = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in kw.items())
+	return "{" + s + "}"
+
+class MetricWriter:
+	"""
+	Collects samples per metric family, so that the HELP/TYPE lines and all
+	samples of a family are written once and contiguous, as the text format
+	requires, no matter in which order the miners add them.
+	"""
+	def __init__(self):
+		self.families = {}
+
+	def declare(self, name, mtype, text):
+		if name not in self.families:
+			self.families[name] = (mtype, text, [])
+
+	def sample(self, name, labels, value, suffix=""):
+		self.families[name][2].append(f"{name}{suffix}{labels} {_fmt(value)}")
+
+	def text(self):
+		lines = []
+		for name, (mtype, text, samples) in self.families.items():
+			if not samples:
+				continue
+			lines.append(f"# HELP {name} {text}")
+			lines.append(f"# TYPE {name} {mtype}")
+			lines += samples
+		return "\n".join(lines) + "\n"
+
+def render_metrics(miners):
+	"""
+	Render the state of all miners in the Prometheus text exposition format.
+	"""
+	w = MetricWriter()
+	w.declare("whatsminer_up", "gauge", "1 if the last poll succeeded completely")
+	w.declare("whatsminer_last_poll_timestamp_seconds", "gauge", "Time of the last poll")
+	for field, name, text in MINER_GAUGES:
+		w.declare(name, "gauge", text)
+	w.declare("whatsminer_fan_speed_rpm", "gauge", "Fan speed")
+	for field, name, text in BOARD_GAUGES:
+		w.declare(name, "gauge", text)
+	w.declare("whatsminer_poll_duration_seconds", "histogram", "Duration of a complete miner poll")
+	w.declare("whatsminer_poll_errors_total", "counter", "Failed miner API requests")
+	for m in miners:
+		lbl = _labels(miner=m.hostname)
+		snap = m.snapshot
+		w.sample("whatsminer_up", lbl, 1 if snap is not None and not snap["errors"] else 0)
+		if snap is not None:
+			w.sample("whatsminer_last_poll_timestamp_seconds", lbl, snap["ts"])
+		if m.values is not None:
+			for field, name, text in MINER_GAUGES:
+				w.sample(name, lbl, m.values[field])
+			for field, fan in FAN_FIELDS:
+				w.sample("whatsminer_fan_speed_rpm", _labels(miner=m.hostname, fan=fan), m.values[field])
+		edevs = snap.get("edevs", None) if snap is not None else None
+		devs = edevs.get("DEVS", []) if isinstance(edevs, dict) else []
+		for i, dev in enumerate(devs):
+			blbl = _labels(miner=m.hostname, board=board_id(i, dev))
+			for field, name, text in BOARD_GAUGES:
+				try:
+					w.sample(name, blbl, float(dev[field]))
+				except (KeyError, TypeError, ValueError):
+					pass
+		h = m.poll_duration
+		name = "whatsminer_poll_duration_seconds"
+		for b, c in zip(h.buckets, h.counts):
+			w.sample(name, _labels(miner=m.hostname, le=_fmt(b)), c, "_bucket")
+		w.sample(name, _labels(miner=m.hostname, le="+Inf"), h.count, "_bucket")
+		w.sample(name, lbl, h.sum, "_sum")
+		w.sample(name, lbl, h.count, "_count")
+		for cmd, n in sorted(m.poll_errors.items()):
+			w.sample("whatsminer_poll_errors_total", _labels(miner=m.hostname, cmd=cmd), n)
+	return w.text()
+
+class MetricsServer:
+	"""
+	Minimal asyncio HTTP server answering GET /metrics.
+	"""
+	def __init__(self, miners, port, host=None):
+		self.miners = miners
+		self.port = port
+		self.host = host
+		self.server = None
+
+	async def start(self):
+		self.server = await asyncio.start_server(self.handle, self.host, self.port)
+		print(f"Metrics: Serving on port {self.port}", flush=True)
+
+	async def handle(self, reader, writer):
+		try:
+			req = await asyncio.wait_for(reader.readline(), 5.0)
+			# Skip the request headers
+			while True:
+				l = await asyncio.wait_for(reader.readline(), 5.0)
+				if l in (b"\r\n", b"\n", b""):
+					break
+			parts = req.decode("latin-1").split()
+			if len(parts) >= 2 and parts[0] in ("GET", "HEAD") and parts[1].split("?")[0] == "/metrics":
+				body = render_metrics(self.miners).encode("utf-8")
+				status = "200 OK"
+				ctype = "text/plain; version=0.0.4; charset=utf-8"
+			else:
+				body = b"Not found\n"
+				status = "404 Not Found"
+				ctype = "text/plain"
+			head = f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+			writer.write(head.encode("latin-1"))
+			if parts and parts[0] != "HEAD":
+				writer.write(body)
+			await writer.drain()
+		except (asyncio.TimeoutError, OSError, UnicodeDecodeError):
+			pass
+		finally:
+			writer.close()
@@ -0,0 +1,111 @@
+# Closed-loop power control for wmpower.
+#
+# Modulates the heat output of a miner by stepping its clock with the
+# set_target_freq command instead of switching it on and off. See the Readme:
+# clock control works down to -50%, below that the clock control of the M31S
+# becomes unstable, so that limit is never crossed.
+
+import math
+from time import monotonic
+
+class PowerController:
+	MIN_PERCENT = -50	# Never go below, see above
+	MAX_PERCENT = 0
+	MAX_STEP = 10		# Maximum change per step in percent
+	MIN_STEP_INTERVAL = 60.0	# Seconds between two frequency changes
+	SETTLE_TIME = 45.0	# Seconds to wait before checking the effect of a step
+	DEADBAND = 50		# Watt
+	MAX_FAILED = 3		# Give up after this many steps without effect
+	HASHING_POWER = 300	# Watt, below this the miner isn't hashing
+
+	def __init__(self, wm, watts_per_percent=39.0):
+		self.wm = wm
+		self.target = None
+		self.percent = 0
+		# Initial guess from M31S: ~3400 W at 0%, ~1460 W at -50%
+		self.watts_per_percent = watts_per_percent
+		self.t_step = -self.MIN_STEP_INTERVAL
+		self.pending = None	# (percent before, power before) of an unverified step
+		self.failed = 0
+		self.steps = 0
+		self.enabled = True
+
+	def set_target(self, watts):
+		"""
+		Set target power in Watt, 0 to stop mining, None to disable control.
+		"""
+		if watts is not None:
+			watts = float(watts)
+			if not math.isfinite(watts):
+				raise ValueError(f"Invalid power target {watts}")
+			watts = max(0, watts)
+		self.target = watts
+		self.failed = 0
+		self.enabled = True
+
+	async def _command(self, cmd, args):
+		# Also rate limits retries if the command fails
+		self.t_step = monotonic()
+		self.steps += 1
+		await self.wm.async_run_command(cmd, args)
+
+	def _verify(self, power):
+		before, p0 = self.pending
+		self.pending = None
+		dpct = self.percent - before
+		dp = power - p0
+		if dpct * dp > 0 and abs(dp) >= 0.25 * abs(dpct) * self.watts_per_percent:
+			# Step had the expected effect, refine the estimate
+			self.watts_per_percent = 0.7 * self.watts_per_percent + 0.3 * abs(dp / dpct)
+			self.failed = 0
+			return
+		self.failed += 1
+		print(f"PowerController: set_target_freq {self.percent}% had no effect ({p0}W -> {power}W)", flush=True)
+		if self.failed >= self.MAX_FAILED:
+			print("PowerController: Giving up, firmware doesn't seem to support set_target_freq", flush=True)
+			self.enabled = False
+
+	async def update(self, values, upfreq=False):
+		"""
+		Called after every poll with the SENSOR values. Returns True if a
+		command was sent to the miner.
+		"""
+		if self.target is None or not self.enabled:
+			return False
+		if upfreq:
+			# Power isn't meaningful until the boards have finished upfreq
+			return False
+		power = values["Power"]
+		t = monotonic()
+		if self.pending is not None:
+			if t - self.t_step < self.SETTLE_TIME:
+				return False
+			self._verify(power)
+			if not self.enabled:
+				return False
+		if t - self.t_step < self.MIN_STEP_INTERVAL:
+			return False
+		hashing = power > self.HASHING_POWER
+		if self.target == 0:
+			if hashing:
+				await self._command("power", ["off"])
+				return True
+			return False
+		if not hashing:
+			if self.target >= self.HASHING_POWER:
+				await self._command("power", ["on"])
+				return True
+			return False
+		err = self.target - power
+		if abs(err) <= self.DEADBAND:
+			return False
+		step = round(err / self.watts_per_percent)
+		step = max(-self.MAX_STEP, min(self.MAX_STEP, step))
+		pct = max(self.MIN_PERCENT, min(self.MAX_PERCENT, self.percent + step))
+		if pct == self.percent:
+			return False
+		await self._command("set_target_freq", [str(pct)])
+		# Only a step the miner accepted can be verified
+		self.pending = (self.percent, power)
+		self.percent = pct
+		return True
@@ -0,0 +1,28 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from whatsminer import WhatsminerAccessToken, WhatsminerAPIError
+
+class TestTokenInfo(unittest.TestCase):
+	def setUp(self):
+		# No connection, only what _set_token_info needs
+		self.token = WhatsminerAccessToken.__new__(WhatsminerAccessToken)
+		self.token.ip_address = "127.0.0.1"
+		self.token._admin_password = "admin"
+
+	def test_bad_responses(self):
+		for data in (None, b"", b"not json", b"[]", b'{"STATUS": "E"}',
+				b'{"Msg": "over max connect"}', b'{"Msg": {"salt": "BQ5hoXV9"}}',
+				b'{"Msg": {"salt": 5, "time": "1", "newsalt": "x"}}'):
+			with self.assertRaises(WhatsminerAPIError, msg=data):
+				self.token._set_token_info(data)
+
+	def test_valid_response(self):
+		self.token._set_token_info(b'{"Msg": {"salt": "BQ5hoXV9", "time": "4199", "newsalt": "c0Qa8RTG"}}')
+		self.assertEqual(len(self.token.sign), 22)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from boards import BoardHistory, RingBuffer
+from wmpower import HAMiner, Whatsminer
+from wmsim import SimMiner, SimServer
+
+class TestRingBuffer(unittest.TestCase):
+	def test_clamp_is_counted(self):
+		b = RingBuffer(4, "H", "test")
+		b.append(70000)
+		b.append(-1)
+		b.append(5)
+		self.assertEqual(list(b.values()), [65535, 0, 5])
+		self.assertEqual(b.clipped, 2)
+
+	def test_clamp_reported_once(self):
+		b = RingBuffer(4, "H", "test")
+		with mock.patch("builtins.print") as p:
+			for i in range(3):
+				b.append(70000)
+		self.assertEqual(p.call_count, 1)
+		self.assertEqual(b.clipped, 3)
+
+	def test_errors_past_16_bit(self):
+		b = BoardHistory(4, 0)
+		b.update({"Hardware Errors": 70000}, True)
+		self.assertEqual(b.buffers["Errors"].last(), 70000)
+		self.assertEqual(b.buffers["Errors"].clipped, 0)
+
+class TestBoardPoll(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.server = SimServer(SimMiner(), port=0)
+		await self.server.start()
+		port = self.server.server.sockets[0].getsockname()[1]
+		self.miner = HAMiner(Whatsminer(f"127.0.0.1:{port}", None), "sim")
+
+	async def asyncTearDown(self):
+		self.miner.wm.token.close()
+		self.server.server.close()
+		await self.server.server.wait_closed()
+
+	async def test_poll_fills_board_details(self):
+		await self.miner.poll_stats()
+		self.assertEqual(self.miner.snapshot["errors"], {})
+		details = self.miner.boards.details
+		self.assertIsNotNone(details)
+		self.assertEqual(sorted(details), ["0", "1", "2"])
+		self.assertEqual(details["0"]["Model"], "M31S.V10")
+		self.assertEqual(sorted(self.miner.boards.boards), ["0", "1", "2"])
+
+	async def test_devdetails_polled_once(self):
+		await self.miner.poll_stats()
+		await self.miner.poll_stats()
+		self.assertNotIn("devdetails", self.miner.snapshot)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,43 @@
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wmpower import HAFleet, HAMiner, Whatsminer
+
+class TestMinerFailure(unittest.IsolatedAsyncioTestCase):
+	"""
+	A miner that accepts the connection and closes without answering.
+	"""
+	async def asyncSetUp(self):
+		async def handle(reader, writer):
+			await reader.read(4096)
+			writer.close()
+		self.server = await asyncio.start_server(handle, "127.0.0.1", 0)
+		port = self.server.sockets[0].getsockname()[1]
+		self.miner = HAMiner(Whatsminer(f"127.0.0.1:{port}", "admin"), "dead")
+
+	async def asyncTearDown(self):
+		self.server.close()
+		await self.server.wait_closed()
+
+	async def test_poll_error_counted(self):
+		await self.miner.poll_stats()
+		self.assertTrue(self.miner.snapshot["errors"])
+		self.assertEqual(sum(self.miner.poll_errors.values()), 1)
+		self.assertFalse(self.miner.wm.online)
+
+	async def test_fleet_survives(self):
+		fleet = HAFleet([self.miner], None, "user", None)
+		task = asyncio.create_task(fleet.run())
+		await asyncio.sleep(0.5)
+		self.assertFalse(task.done())
+		fleet._disconnected.set()
+		self.miner.scheduler.kick()
+		await asyncio.wait_for(task, 2)
+		self.assertGreaterEqual(sum(self.miner.poll_errors.values()), 1)
+
+if __name__ == "__main__":
+	unittest.main()
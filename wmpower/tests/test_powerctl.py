@@ -0,0 +1,63 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from whatsminer import WhatsminerAPIError
+from wmpower import HAMiner, Whatsminer
+from powerctl import PowerController
+from wmsim import SimMiner, SimServer
+
+class TestPowerControllerErrors(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.server = SimServer(SimMiner("admin"), port=0)
+		await self.server.start()
+		self.port = self.server.server.sockets[0].getsockname()[1]
+
+	async def asyncTearDown(self):
+		self.server.server.close()
+		await self.server.server.wait_closed()
+
+	async def test_step_applied(self):
+		wm = Whatsminer(f"127.0.0.1:{self.port}", "admin")
+		ctl = PowerController(wm)
+		ctl.set_target(2000)
+		self.assertTrue(await ctl.update({"Power": 3400}))
+		self.assertEqual(ctl.percent, -10)
+		self.assertEqual(ctl.pending, (0, 3400))
+		self.assertEqual(self.server.miner.percent, -10)
+		wm.token.close()
+
+	async def test_failed_step_not_recorded(self):
+		# Wrong password: the miner can't decrypt the command and answers with an error
+		wm = Whatsminer(f"127.0.0.1:{self.port}", "wrong")
+		ctl = PowerController(wm)
+		ctl.set_target(2000)
+		with self.assertRaises(WhatsminerAPIError):
+			await ctl.update({"Power": 3400})
+		self.assertEqual(ctl.percent, 0)
+		self.assertIsNone(ctl.pending)
+		self.assertEqual(self.server.miner.percent, 0)
+		wm.token.close()
+
+class TestPowerTargetMessage(unittest.TestCase):
+	def setUp(self):
+		self.miner = HAMiner(Whatsminer("127.0.0.1", "admin"), "test")
+
+	def set(self, payload):
+		self.miner.mqtt_message("wmpower/test/whatsminer/power_target", payload)
+		return self.miner.powerctl.target
+
+	def test_non_finite_rejected(self):
+		self.set(b"1500")
+		for payload in (b"inf", b"-inf", b"nan", b"1e999", b"abc"):
+			self.assertEqual(self.set(payload), 1500)
+
+	def test_clamped_to_range(self):
+		self.assertEqual(self.set(b"100000"), HAMiner.POWER_TARGET_MAX)
+		self.assertEqual(self.set(b"-5"), HAMiner.POWER_TARGET_MIN)
+		self.assertIsNone(self.set(b"off"))
+
+if __name__ == "__main__":
+	unittest.main()
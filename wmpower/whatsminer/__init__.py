@@ -1 +1,4 @@
-from .api import WhatsminerAccessToken, WhatsminerAPI
\ No newline at end of file
+from .api import WhatsminerAccessToken, WhatsminerAPI, WhatsminerAPIError, WhatsminerConnection, WriteKeyCache, write_key_cache
+from .api import ResponseCache, read_only_cache
+from .aio import AsyncWhatsminerAPI, AsyncWhatsminerConnection
+from .jsonfix import repair_loads, repair_stats
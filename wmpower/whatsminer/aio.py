@@ -0,0 +1,199 @@
+"""
+asyncio flavour of the Whatsminer API.
+
+    Uses the same WhatsminerAccessToken as the blocking API, but talks to the
+    miner through asyncio streams, so many miners can be polled concurrently
+    from a single event loop without threads.
+
+    token = WhatsminerAccessToken(ip_address="1.2.3.4")
+    await AsyncWhatsminerAPI.enable_write_access(token, "xxxx")
+    await AsyncWhatsminerAPI.get_read_only_info(token, "summary", timeout=5.0)
+    await AsyncWhatsminerAPI.exec_command(token, "power_on")
+"""
+import asyncio
+import json
+import logging
+
+from .api import WhatsminerAccessToken, WhatsminerAPI, ResponseScanner, MAX_RESPONSE_SIZE
+from .api import ResponseCache, read_only_cache
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncWhatsminerConnection:
+    """ asyncio counterpart of WhatsminerConnection.
+        Keeps the stream open between calls if the firmware allows it. A request
+        that times out or gets cancelled closes the stream, so a late answer can
+        never be mistaken for the response to the next request.
+    """
+    def __init__(self, ip_address: str, port: int = 4028, keepalive: bool = True):
+        self.ip_address = ip_address
+        self.port = port
+        self.keepalive = keepalive
+        self.reader = None
+        self.writer = None
+        self.connects = 0
+        self.reuses = 0
+        self._lock = None
+
+    def _get_lock(self):
+        # Created lazily so the lock binds to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.ip_address, self.port)
+        self.connects += 1
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except (OSError, RuntimeError):
+                pass
+            self.reader = None
+            self.writer = None
+
+    async def _read_response(self, n=MAX_RESPONSE_SIZE):
+        data = bytearray()
+        scanner = ResponseScanner()
+        while len(data) < n:
+            packet = await self.reader.read(min(65536, n - len(data)))
+            if not packet:
+                return (bytes(data) if data else None), True
+            data.extend(packet)
+            if scanner.feed(packet):
+                return bytes(data[:scanner.end]), False
+        return bytes(data), False
+
+    async def _request(self, payload, want_response):
+        for attempt in range(2):
+            reused = False
+            if self.writer is not None:
+                if self.reader.at_eof():
+                    self.close()
+                    self.keepalive = False
+                else:
+                    reused = True
+            if self.writer is None:
+                await self._connect()
+            try:
+                self.writer.write(payload)
+                await self.writer.drain()
+                if not want_response:
+                    self.close()
+                    return None
+                data, eof = await self._read_response()
+            except OSError:
+                self.close()
+                if reused:
+                    self.keepalive = False
+                    continue
+                raise
+            if not data and reused:
+                self.close()
+                self.keepalive = False
+                continue
+            if reused:
+                self.reuses += 1
+            if eof or not self.keepalive:
+                self.close()
+            return data
+        return None
+
+    def busy(self):
+        return self._lock is not None and self._lock.locked()
+
+    async def request(self, payload: bytes, want_response: bool = True, timeout: float = None):
+        """ Send payload and return the raw response bytes.
+            timeout is a deadline for the whole request including connect.
+        """
+        async with self._get_lock():
+            try:
+                return await asyncio.wait_for(self._request(payload, want_response), timeout)
+            except BaseException:
+                # Timeout, cancellation or I/O error: stream state is unknown
+                self.close()
+                raise
+
+
+# Upper limit of concurrent connections to a single miner. The firmware answers
+# "over max connect" if too many are open at once.
+MAX_CONNECTIONS = 3
+
+
+def get_connection(access_token: WhatsminerAccessToken):
+    """ Return an idle AsyncWhatsminerConnection of access_token, opening a new one
+        for concurrent requests up to MAX_CONNECTIONS. If all are busy, the
+        least used one is returned and the request queues on its lock.
+    """
+    pool = access_token.aconnections
+    for conn in pool:
+        if not conn.busy():
+            return conn
+    if len(pool) < MAX_CONNECTIONS:
+        conn = AsyncWhatsminerConnection(access_token.ip_address, access_token.port)
+        pool.append(conn)
+        return conn
+    return min(pool, key=lambda c: c.connects + c.reuses)
+
+
+class AsyncWhatsminerAPI:
+    """ Stateless classmethod-only async read/write API calls. """
+
+    @classmethod
+    async def enable_write_access(self, access_token: WhatsminerAccessToken, admin_password: str, timeout: float = None):
+        access_token._admin_password = admin_password
+        await self._initialize_write_access(access_token, timeout)
+
+    @classmethod
+    async def _initialize_write_access(self, access_token: WhatsminerAccessToken, timeout: float = None):
+        data = await get_connection(access_token).request(b'{"cmd": "get_token"}', timeout=timeout)
+        access_token._set_token_info(data)
+
+    @classmethod
+    async def has_write_access(self, access_token: WhatsminerAccessToken, timeout: float = None):
+        """ Checks write access and refreshes token, if necessary. """
+        if not access_token._admin_password:
+            return False
+        if access_token.write_access_expired():
+            await self._initialize_write_access(access_token, timeout)
+        return True
+
+    @classmethod
+    async def get_read_only_info(self, access_token: WhatsminerAccessToken, cmd: str, additional_params: dict = None, timeout: float = None, max_age: float = None):
+        """ Send READ-ONLY API command.
+
+            Returns: json response, possibly from read_only_cache (see WhatsminerAPI)
+        """
+        key = ResponseCache.key((access_token.ip_address, access_token.port), cmd, additional_params)
+        ret = read_only_cache.get(key, max_age)
+        if ret is not None:
+            return ret
+
+        json_cmd = {"cmd": cmd}
+        if additional_params:
+            json_cmd.update(additional_params)
+
+        data = await get_connection(access_token).request(json.dumps(json_cmd).encode('utf-8'), timeout=timeout)
+        ret = WhatsminerAPI._parse_read_only(data)
+        read_only_cache.put(key, ret, max_age)
+        return ret
+
+    @classmethod
+    async def exec_command(self, access_token: WhatsminerAccessToken, cmd: str, additional_params: dict = None, timeout: float = None):
+        """ Send WRITEABLE API command.
+
+            Returns: json response
+        """
+        if not await self.has_write_access(access_token, timeout):
+            raise Exception("access_token must have write access")
+
+        api_cmd, api_packet = WhatsminerAPI._encode_command(access_token, cmd, additional_params)
+        read_only_cache.invalidate((access_token.ip_address, access_token.port))
+        data = await get_connection(access_token).request(api_packet, want_response=(cmd != "power_off"), timeout=timeout)
+        if cmd == "power_off":
+            return None
+
+        return WhatsminerAPI._decode_response(access_token, api_cmd, data)
@@ -4,8 +4,8 @@ with the following credit:
  * @Author: passby
  * @Date: 2020-07-23 00:16:29 
 """
-import base64
 import binascii
+import collections
 import datetime
 import hashlib
 import json
@@ -14,11 +14,15 @@ import os
 import re
 import select
 import socket
+import threading
+import time
 
 from base64 import b64encode, b64decode
 from Cryptodome.Cipher import AES
 from passlib.hash import md5_crypt
 
+from .jsonfix import repair_loads
+
 logger = logging.getLogger(__name__)
 
 
@@ -38,9 +42,136 @@ logger = logging.getLogger(__name__)
 
     # Writeable API
     WhatsminerAPI.exec_command(token1, "power_off", additional_params={"respbefore": "true"})
+
+    Each token owns a WhatsminerConnection, which keeps the TCP connection to the
+    miner open between calls if the firmware allows it. Call token.close() when done.
 """
 
 
+class WhatsminerAPIError(Exception):
+    """ The miner answered with an error status or an undecodable response. """
+
+
+class WhatsminerConnection:
+    """ Connection manager for a single Whatsminer ASIC.
+        Reuses the TCP socket between API calls and reconnects on demand. If the
+        firmware turns out to close the connection after every response, it falls
+        back to connect-per-call for the rest of its lifetime.
+    """
+    def __init__(self, ip_address: str, port: int = 4028, timeout: float = 10.0, keepalive: bool = True):
+        self.ip_address = ip_address
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.sock = None
+        self.connects = 0
+        self.reuses = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.ip_address, self.port), timeout=self.timeout)
+        self.connects += 1
+
+    def _is_stale(self):
+        # An idle socket should never be readable. If it is, the peer has
+        # closed it (EOF) or sent garbage we can't use anyway.
+        try:
+            r, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(r)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def request(self, payload: bytes, want_response: bool = True):
+        """ Send payload and return the raw response bytes (or None if
+            want_response is False or the peer closed without answering).
+        """
+        with self._lock:
+            for attempt in range(2):
+                reused = False
+                if self.sock is not None:
+                    if self._is_stale():
+                        self.close()
+                        self.keepalive = False
+                    else:
+                        reused = True
+                if self.sock is None:
+                    self._connect()
+                try:
+                    self.sock.sendall(payload)
+                    if not want_response:
+                        self.close()
+                        return None
+                    data, eof = recv_response(self.sock)
+                except OSError:
+                    self.close()
+                    if reused:
+                        # Peer dropped the idle connection, retry once on a fresh one
+                        self.keepalive = False
+                        continue
+                    raise
+                if not data and reused:
+                    self.close()
+                    self.keepalive = False
+                    continue
+                if reused:
+                    self.reuses += 1
+                if eof or not self.keepalive:
+                    self.close()
+                return data
+        return None
+
+
+class WriteKeyCache:
+    """ Cache for the md5_crypt derived values of the write access handshake.
+        The key only depends on (host, password, salt) and the sign on
+        (host, key, time, newsalt), so a repeated get_token with the same
+        answer doesn't need to run the 1000 round hashes again.
+        Least recently used entries are evicted first, so the long-lived key
+        of every miner survives the churn of sign entries.
+    """
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def crypt(self, host: str, word: str, salt: str):
+        """ Cached crypt(word, "$1$" + salt + "$"), returns the hash part. """
+        k = (host, word, salt)
+        with self._lock:
+            ret = self._cache.get(k, None)
+            if ret is not None:
+                self._cache.move_to_end(k)
+                self.hits += 1
+                return ret
+            self.misses += 1
+        ret = crypt(word, "$1$" + salt + '$').split('$')[3]
+        with self._lock:
+            self._cache[k] = ret
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return ret
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+write_key_cache = WriteKeyCache()
+
+
 class WhatsminerAccessToken:
     """ Reusable token to access and/or control a single Whatsminer ASIC.
         Token will renew itself as needed if it expires.
@@ -52,6 +183,8 @@ class WhatsminerAccessToken:
         self.ip_address = ip_address
         self.port = port
         self._admin_password = admin_password
+        self.connection = WhatsminerConnection(ip_address, port)
+        self.aconnections = []      # Created on demand by the asyncio API
 
         if self._admin_password:
             self._initialize_write_access()
@@ -69,50 +202,147 @@ class WhatsminerAccessToken:
 
         Final assembly: enc|base64(aes256("token,sign|set_led|auto", $aeskey))
         """
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((self.ip_address, self.port))
-            s.sendall('{"cmd": "get_token"}'.encode('utf-8'))
-            data = recv_all(s, 4000)
+        data = self.connection.request('{"cmd": "get_token"}'.encode('utf-8'))
+        self._set_token_info(data)
 
-        token_info = json.loads(data)["Msg"]
-        if token_info == "over max connect":
-            raise Exception(data)
 
-        # Make the encrypted key from the admin password and the salt
-        pwd = crypt(self._admin_password, "$1$" + token_info["salt"] + '$')
-        pwd = pwd.split('$')
-        key = pwd[3]
+    def _set_token_info(self, data):
+        """ Derive the AES key and sign from a get_token response. """
+        if data is None:
+            raise WhatsminerAPIError("no response to get_token")
+        try:
+            token_info = json.loads(data)["Msg"]
+            if token_info == "over max connect":
+                raise WhatsminerAPIError(data)
+
+            # Make the encrypted key from the admin password and the salt
+            key = write_key_cache.crypt(self.ip_address, self._admin_password, token_info["salt"])
+
+            # Make the 'sign' that is passed in as 'token'
+            self.sign = write_key_cache.crypt(self.ip_address, key + token_info["time"], token_info["newsalt"])
+        except WhatsminerAPIError:
+            raise
+        except (ValueError, TypeError, KeyError) as e:
+            raise WhatsminerAPIError(f"invalid get_token response {data!r}") from e
 
         # Make the aeskey from the key computed above and prep the AES cipher
         aeskey = hashlib.sha256(key.encode()).hexdigest()
         aeskey = binascii.unhexlify(aeskey.encode())
         self.cipher = AES.new(aeskey, AES.MODE_ECB)
 
-        # Make the 'sign' that is passed in as 'token'
-        tmp = crypt(pwd[3] + token_info["time"], "$1$" + token_info["newsalt"] + '$')
-        tmp = tmp.split('$')
-        self.sign = tmp[3]
-
         self.created = datetime.datetime.now()
 
 
+    def encrypt_frame(self, plaintext):
+        """ Encrypt a plaintext command (bytes-like) into the transport packet
+            b'{"enc": 1, "data": "<base64>"}'.
+            The zero padding is added in one go, base64 of the ciphertext never
+            contains characters that need JSON escaping.
+        """
+        buf = bytearray(plaintext)
+        pad = -len(buf) % 16
+        if pad:
+            buf.extend(bytes(pad))
+        enc = b64encode(self.cipher.encrypt(buf))
+        return b'{"enc": 1, "data": "' + enc + b'"}'
+
+
+    def decrypt_frame(self, enc):
+        """ Decrypt the base64 "enc" field of a response and parse the JSON. """
+        plaintext = self.cipher.decrypt(b64decode(enc))
+        end = plaintext.find(b"\x00")
+        if end >= 0:
+            plaintext = plaintext[:end]
+        return json.loads(plaintext)
+
+
     def enable_write_access(self, admin_password: str):
         self._admin_password = admin_password
         self._initialize_write_access()
 
 
+    def write_access_expired(self):
+        return (datetime.datetime.now() - self.created).total_seconds() > 30 * 60
+
+
+    def invalidate(self):
+        """ Force a new get_token handshake on the next writeable command. """
+        self.created = datetime.datetime.min
+
+
     def has_write_access(self):
         """ Checks write access and refreshes token, if necessary. """
         if not self._admin_password:
             return False
 
-        if (datetime.datetime.now() - self.created).total_seconds() > 30 * 60:
+        if self.write_access_expired():
             # writeable token has expired; reinitialize
             self._initialize_write_access()
 
         return True
 
 
+    def close(self):
+        self.connection.close()
+        for conn in self.aconnections:
+            conn.close()
+
+
+
+class ResponseCache:
+    """ TTL cache for read-only responses, keyed by (host, cmd, params).
+        Shared by everything in the process that polls the same miner, so an
+        MQTT publisher, the CLI and an HTTP exporter can all use one poll result.
+        Cached responses are shared objects and must not be modified.
+        ttl is the default max_age. With a ttl of 0 only calls that pass their
+        own max_age are cached.
+    """
+    def __init__(self, ttl: float = 0.0):
+        self.ttl = ttl
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(host, cmd: str, additional_params: dict = None):
+        params = tuple(sorted(additional_params.items())) if additional_params else ()
+        return (host, cmd, params)
+
+    def get(self, key, max_age: float = None):
+        if max_age is None:
+            max_age = self.ttl
+        if max_age <= 0:
+            return None
+        with self._lock:
+            entry = self._cache.get(key, None)
+            if entry is not None and time.monotonic() - entry[0] <= max_age:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def put(self, key, value, max_age: float = None):
+        """ Store value, if the call that fetched it uses the cache. """
+        if max_age is None:
+            max_age = self.ttl
+        if max_age <= 0:
+            return
+        with self._lock:
+            self._cache[key] = (time.monotonic(), value)
+
+    def invalidate(self, host=None):
+        """ Drop all entries of host (ip, port), or everything if host is None. """
+        with self._lock:
+            if host is None:
+                self._cache.clear()
+            else:
+                for k in [k for k in self._cache if k[0] == host]:
+                    del self._cache[k]
+
+
+read_only_cache = ResponseCache()
+
 
 class WhatsminerAPI:
     """ Stateless classmethod-only read/write API calls. Use a WhatsminerAccessToken
@@ -120,29 +350,40 @@ class WhatsminerAPI:
     """
 
     @classmethod
-    def get_read_only_info(self, access_token: WhatsminerAccessToken, cmd: str, additional_params: dict = None):
+    def get_read_only_info(self, access_token: WhatsminerAccessToken, cmd: str, additional_params: dict = None, max_age: float = None):
         """ Send READ-ONLY API command.
 
             e.g. WhatsminerAPI.get_read_only_info(access_token, cmd="summary")
 
+            A response at most max_age seconds old (default: read_only_cache.ttl)
+            is served from read_only_cache without contacting the miner.
+
             Returns: json response
         """
+        key = ResponseCache.key((access_token.ip_address, access_token.port), cmd, additional_params)
+        ret = read_only_cache.get(key, max_age)
+        if ret is not None:
+            return ret
+
         json_cmd = {"cmd": cmd}
         if additional_params:
             json_cmd.update(additional_params)
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((access_token.ip_address, access_token.port))
-            s.send(json.dumps(json_cmd).encode('utf-8'))
-            data = recv_all(s, 4000)
+        data = access_token.connection.request(json.dumps(json_cmd).encode('utf-8'))
+        ret = self._parse_read_only(data)
+        read_only_cache.put(key, ret, max_age)
+        return ret
 
-        s = data.decode()
+    @classmethod
+    def _parse_read_only(self, data: bytes):
+        s = data.decode().rstrip("\x00")
 
-        # Try to patch some known JSON formatting errors
         try:
             ret = json.loads(s)
         except json.decoder.JSONDecodeError:
-            ret = json.loads(s.replace(",}", "}").replace('"1""', '"1","'))
+            # Repair known firmware JSON formatting errors in one pass
+            ret, fixes = repair_loads(s)
+            logger.debug("Repaired malformed JSON response: %s", ", ".join(fixes))
         return ret
 
     @classmethod
@@ -156,45 +397,53 @@ class WhatsminerAPI:
         if not access_token.has_write_access():
             raise Exception("access_token must have write access")
 
+        api_cmd, api_packet = self._encode_command(access_token, cmd, additional_params)
+
+        # Whatever this command changes, cached state of this miner is stale now
+        read_only_cache.invalidate((access_token.ip_address, access_token.port))
+
+        # power_off with respbefore may or may not answer, so don't wait for it
+        data = access_token.connection.request(api_packet, want_response=(cmd != "power_off"))
+        if cmd == "power_off":
+            return None
+
+        return self._decode_response(access_token, api_cmd, data)
+
+    @classmethod
+    def _encode_command(self, access_token: WhatsminerAccessToken, cmd: str, additional_params: dict = None):
+        """ Build the encrypted transport packet for a writeable command.
+
+            Returns: (plaintext api_cmd, packet bytes)
+        """
         # Assemble the plaintext json
         json_cmd = {"cmd": cmd, "token": access_token.sign}
         if additional_params:
             json_cmd.update(additional_params)
         api_cmd = json.dumps(json_cmd)
 
-        # Encrypt it and assemble the transport json
-        enc_str = str(
-            base64.encodebytes(
-                access_token.cipher.encrypt(add_to_16(api_cmd))),
-                encoding='utf8'
-            ).replace('\n', '')
-        data_enc = {'enc': 1}    # transmit w/ "enc" to signal that it's encrypted
-        data_enc['data'] = enc_str
-        api_packet_str = json.dumps(data_enc)
-
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((access_token.ip_address, access_token.port))
-            s.send(api_packet_str.encode())
-            if cmd == "power_off":
-                return None
-            data = recv_all(s, 4000)
+        return api_cmd, access_token.encrypt_frame(api_cmd.encode())
 
+    @classmethod
+    def _decode_response(self, access_token: WhatsminerAccessToken, api_cmd: str, data: bytes):
+        """ Check and decrypt the response to a writeable command. """
         try:
-            json_response = json.loads(data.decode())
+            json_response = json.loads(data)
             if "STATUS" in json_response and json_response["STATUS"] == "E":
+                # The miner may have dropped our token (e.g. after a reboot)
+                access_token.invalidate()
                 logger.error(json_response["Msg"])
-                raise Exception(api_cmd + "\n" + json_response["Msg"])
+                raise WhatsminerAPIError(api_cmd + "\n" + json_response["Msg"])
 
-            resp_ciphertext = b64decode(json.loads(data.decode())["enc"])
-            resp_plaintext = access_token.cipher.decrypt(resp_ciphertext).decode().split("\x00")[0]
-            resp = json.loads(resp_plaintext)
+            resp = access_token.decrypt_frame(json_response["enc"])
+        except WhatsminerAPIError:
+            raise
         except Exception as e:
             logger.exception("Error decoding encrypted response")
             try:
                 logger.error(data.decode())
             except:
                 pass
-            raise e
+            raise WhatsminerAPIError(api_cmd + "\n" + repr(e)) from e
 
         return resp
 
@@ -211,23 +460,132 @@ def crypt(word, salt):
     return result
 
 
-# Adapted from: https://stackoverflow.com/a/17668009
-def recv_all(sock, n):
-    # Helper function to recv n bytes
-    sock.setblocking(True)
+# Upper limit for a single response. edevs/devdetails easily exceed the 4000
+# bytes the original API code used to read.
+MAX_RESPONSE_SIZE = 1 << 20
+
+
+# Bytes that matter outside of JSON strings: brackets and the NUL terminator
+_MARKS = b"{}[]\x00"
+_NOT_MARKS = bytes(c for c in range(256) if c not in _MARKS)
+
+
+class ResponseScanner:
+    """ Incremental end-of-response detector.
+        Tracks string state and bracket depth across chunks. A response ends
+        when the outermost JSON object is closed or at a NUL terminator,
+        whichever comes first.
+        Strings are cut out with bytes.split and everything but brackets and
+        NUL is dropped with bytes.translate, so Python only looks at those few
+        bytes. Chunks with a backslash escape are scanned byte by byte.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+        self.size = 0
+        self.end = None     # Length of the complete response, once found
+
+    def feed(self, chunk):
+        """ Scan the next chunk. Returns True once the response is complete. """
+        if self.end is not None:
+            return True
+        if self.escape or chunk.find(b"\\") >= 0:
+            return self._feed_bytes(chunk)
+        parts = chunk.split(b'"')
+        first = 1 if self.in_string else 0
+        marks = b"".join(parts[first::2]).translate(None, _NOT_MARKS)
+        depth = self.depth
+        started = self.started
+        for k, c in enumerate(marks):
+            if c == 0x7b or c == 0x5b:      # { [
+                depth += 1
+                started = True
+            elif c == 0x7d or c == 0x5d:    # } ]
+                depth -= 1
+                if started and depth <= 0:
+                    self.end = self.size + _locate_mark(chunk, parts, first, len(marks) - 1 - k) + 1
+                    return True
+            elif c == 0 and started:
+                self.end = self.size + _locate_mark(chunk, parts, first, len(marks) - 1 - k)
+                return True
+        self.depth = depth
+        self.started = started
+        if len(parts) % 2 == 0:
+            self.in_string = not self.in_string
+        self.size += len(chunk)
+        return False
+
+    def _feed_bytes(self, chunk):
+        depth = self.depth
+        in_string = self.in_string
+        escape = self.escape
+        started = self.started
+        for i, c in enumerate(chunk):
+            if in_string:
+                if escape:
+                    escape = False
+                elif c == 0x5c:     # backslash
+                    escape = True
+                elif c == 0x22:     # "
+                    in_string = False
+            elif c == 0x22:
+                in_string = True
+            elif c == 0x7b or c == 0x5b:    # { [
+                depth += 1
+                started = True
+            elif c == 0x7d or c == 0x5d:    # } ]
+                depth -= 1
+                if started and depth <= 0:
+                    self.end = self.size + i + 1
+                    return True
+            elif c == 0 and started:
+                self.end = self.size + i
+                return True
+        self.depth = depth
+        self.in_string = in_string
+        self.escape = escape
+        self.started = started
+        self.size += len(chunk)
+        return False
+
+
+def _locate_mark(chunk, parts, first, after):
+    """ Index in chunk of the mark outside of strings that is followed by
+        after more marks. parts is chunk split at the quotes, parts[first] is
+        the first part outside of a string.
+        Walks backwards, the end of a response is close to the end of a chunk.
+    """
+    pos = len(chunk) + 1
+    for j in range(len(parts) - 1, -1, -1):
+        part = parts[j]
+        pos -= len(part) + 1
+        if (j - first) % 2:
+            continue
+        n = len(part.translate(None, _NOT_MARKS))
+        if after < n:
+            i = len(part)
+            for _ in range(after + 1):
+                i = max(part.rfind(m, 0, i) for m in (b"{", b"}", b"[", b"]", b"\x00"))
+            return pos + i
+        after -= n
+    raise ValueError("mark not found")
+
+
+def recv_response(sock, n=MAX_RESPONSE_SIZE):
+    """ Receive one response of at most n bytes.
+        Stops at EOF or as soon as a complete JSON document has arrived, so
+        neither a kept-alive nor a closing connection has to wait for the
+        peer to close. Returns (data, eof).
+    """
     data = bytearray()
+    scanner = ResponseScanner()
     while len(data) < n:
-        packet = sock.recv(n - len(data))
+        packet = sock.recv(min(65536, n - len(data)))
         if not packet:
-            if data:
-                return data
-            return None
+            return (bytes(data) if data else None), True
         data.extend(packet)
-    return data
-
-
-def add_to_16(s):
-    while len(s) % 16 != 0:
-        s += '\0'
-    return str.encode(s)  # return bytes
-
+        if scanner.feed(packet):
+            return bytes(data[:scanner.end]), False
+    return bytes(data), False
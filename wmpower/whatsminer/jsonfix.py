@@ -0,0 +1,155 @@
+"""
+Tolerant JSON parser for Whatsminer API responses.
+
+    Some firmware versions produce slightly broken JSON, especially in larger
+    responses like edevs and devdetails. This parser repairs the known defects
+    while it parses, in a single pass, and reports what it had to fix:
+
+    trailing_comma : "," directly before "}" or "]"
+    missing_comma  : two members or elements without "," in between, e.g. '"1""'
+    nul_padding    : NUL bytes around or between tokens
+    trailing_data  : garbage after the top-level value (ignored)
+
+    obj, fixes = repair_loads('{"a": "1""b": 2,}')
+    # obj == {"a": "1", "b": 2}, fixes == ["missing_comma", "trailing_comma"]
+
+    Use it as a fallback after json.loads fails, since the C parser is faster
+    for well-formed input.
+"""
+import collections
+import json
+from json.decoder import scanstring
+from json.scanner import NUMBER_RE
+
+# Number of responses each repair has been applied to, process-wide
+repair_stats = collections.Counter()
+
+WHITESPACE = " \t\r\n"
+
+
+class JSONRepairParser:
+    def __init__(self, s: str):
+        self.s = s
+        self.i = 0
+        self.fixes = []
+
+    def _fix(self, kind):
+        if kind not in self.fixes:
+            self.fixes.append(kind)
+            repair_stats[kind] += 1
+
+    def _error(self, msg):
+        raise json.JSONDecodeError(msg, self.s, self.i)
+
+    def _ws(self):
+        s = self.s
+        i = self.i
+        n = len(s)
+        while i < n:
+            c = s[i]
+            if c in WHITESPACE:
+                i += 1
+            elif c == "\x00":
+                self._fix("nul_padding")
+                i += 1
+            else:
+                break
+        self.i = i
+
+    def _peek(self):
+        self._ws()
+        if self.i >= len(self.s):
+            self._error("Unexpected end of data")
+        return self.s[self.i]
+
+    def parse(self):
+        ret = self._value()
+        self._ws()
+        if self.i < len(self.s):
+            self._fix("trailing_data")
+        return ret
+
+    def _value(self):
+        c = self._peek()
+        if c == "{":
+            return self._object()
+        if c == "[":
+            return self._array()
+        if c == '"':
+            ret, self.i = scanstring(self.s, self.i + 1)
+            return ret
+        for word, val in (("true", True), ("false", False), ("null", None)):
+            if self.s.startswith(word, self.i):
+                self.i += len(word)
+                return val
+        m = NUMBER_RE.match(self.s, self.i)
+        if m is None:
+            self._error("Expecting value")
+        integer, frac, exp = m.groups()
+        self.i = m.end()
+        if frac or exp:
+            return float(integer + (frac or "") + (exp or ""))
+        return int(integer)
+
+    def _object(self):
+        ret = {}
+        self.i += 1
+        if self._peek() == "}":
+            self.i += 1
+            return ret
+        while True:
+            if self._peek() != '"':
+                self._error("Expecting property name enclosed in double quotes")
+            key, self.i = scanstring(self.s, self.i + 1)
+            if self._peek() != ":":
+                self._error("Expecting ':' delimiter")
+            self.i += 1
+            ret[key] = self._value()
+            c = self._peek()
+            if c == ",":
+                self.i += 1
+                if self._peek() == "}":
+                    self._fix("trailing_comma")
+                    self.i += 1
+                    return ret
+            elif c == "}":
+                self.i += 1
+                return ret
+            elif c == '"':
+                self._fix("missing_comma")
+            else:
+                self._error("Expecting ',' delimiter")
+
+    def _array(self):
+        ret = []
+        self.i += 1
+        if self._peek() == "]":
+            self.i += 1
+            return ret
+        while True:
+            ret.append(self._value())
+            c = self._peek()
+            if c == ",":
+                self.i += 1
+                if self._peek() == "]":
+                    self._fix("trailing_comma")
+                    self.i += 1
+                    return ret
+            elif c == "]":
+                self.i += 1
+                return ret
+            elif c in '"{[-0123456789tfn':
+                self._fix("missing_comma")
+            else:
+                self._error("Expecting ',' delimiter")
+
+
+def repair_loads(s):
+    """ Parse s (str or bytes), repairing known defects.
+        Returns (obj, fixes) where fixes lists the repairs that were applied.
+        Raises json.JSONDecodeError if s can't be repaired.
+    """
+    if isinstance(s, (bytes, bytearray)):
+        s = s.decode()
+    p = JSONRepairParser(s)
+    return p.parse(), p.fixes
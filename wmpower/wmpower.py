@@ -2,132 +2,367 @@
 
 import os
 import sys
-import functools
 import json
+import math
 import inspect
-from whatsminer import WhatsminerAccessToken, WhatsminerAPI
+from whatsminer import WhatsminerAccessToken, WhatsminerAPI, WhatsminerAPIError, AsyncWhatsminerAPI, read_only_cache
 import gmqtt
 import socket
 import asyncio
+import collections
+from time import time, monotonic
+from exporter import Histogram, MetricsServer, POLL_DURATION_BUCKETS
+from boards import BoardTracker, BOARD_DEADBANDS
+from powerctl import PowerController
 
 class Whatsminer:
 	def __init__(self, host, passwd):
 		self.passwd = passwd
 		self.host = host
+		self.port = 4028
+		if host.count(":") == 1:
+			# <address>:<port>, e.g. for the simulator
+			self.host, port = host.split(":")
+			self.port = int(port)
 		self.online = False
+		self.token = None
+		self.token_reuses = 0
+
+	def _reuse_token(self):
+		"""
+		Keep the existing token across reconnects. A write token stays valid
+		for 30 minutes and renews itself, so there is no need to redo the
+		get_token handshake after every timeout.
+		"""
+		if self.token is None:
+			return False
+		self.token.close()
+		if self.passwd is not None and not hasattr(self.token, "cipher"):
+			return False
+		self.token_reuses += 1
+		return True
 
 	def connect(self):
-		self.token = WhatsminerAccessToken(ip_address=self.host)
-		if self.passwd is not None:
-			self.token.enable_write_access(admin_password=self.passwd)
+		if not self._reuse_token():
+			self.token = WhatsminerAccessToken(ip_address=self.host, port=self.port)
+			if self.passwd is not None:
+				self.token.enable_write_access(admin_password=self.passwd)
 		self.online = True
 
 	def set_offline(self):
 		self.online = False
+		if self.token is not None:
+			# Connection is likely broken after a timeout, don't reuse it
+			self.token.close()
 
-	def run_command(self, cmd, args=None):
-		if not self.online:
-			self.connect()
-		wacmd = functools.partial(WhatsminerAPI.exec_command, access_token=self.token)
-		waro = functools.partial(WhatsminerAPI.get_read_only_info, access_token=self.token)
+	async def async_connect(self, timeout=5.0):
+		if not self._reuse_token():
+			self.token = WhatsminerAccessToken(ip_address=self.host, port=self.port)
+			if self.passwd is not None:
+				await AsyncWhatsminerAPI.enable_write_access(self.token, self.passwd, timeout=timeout)
+		self.online = True
+
+	def _lookup_command(self, cmd, args):
+		"""
+		Translate a wmpower command into an API call.
+		Returns (writeable, api command, additional params) or None.
+		"""
 		if cmd == "power":
 			onoff = args[0]
 			if onoff == "on":
-				resp = wacmd(cmd="power_on")
+				return True, "power_on", None
 			elif onoff == "off":
-				resp = wacmd(cmd="power_off", additional_params={"respbefore": "true"})
+				return True, "power_off", {"respbefore": "true"}
 			else:
 				print("Error: unknown parameter to power command")
 				return None
-		elif cmd == "summary":
-			resp = waro(cmd="summary")
-		elif cmd == "status":
-			resp = waro(cmd="status")
+		elif cmd in ("summary", "status", "edevs", "devdetails", "get_psu"):
+			return False, cmd, None
 		elif cmd == "led":
 			mode = args[0]
-			resp = wacmd(cmd="set_led", additional_params={"param": mode})
+			return True, "set_led", {"param": mode}
 		elif cmd == "set_target_freq":
 			freq = args[0]
-			resp = wacmd(cmd="set_target_freq", additional_params={"percent": freq})
-		elif cmd == "edevs":
-			resp = waro(cmd="edevs")
-		elif cmd == "get_psu":
-			resp = waro(cmd="get_psu")
-		else:
-			print(f"Error: Unknown command {cmd}")
+			return True, "set_target_freq", {"percent": freq}
+		print(f"Error: Unknown command {cmd}")
+		return None
+
+	def run_command(self, cmd, args=None):
+		if not self.online:
+			self.connect()
+		c = self._lookup_command(cmd, args)
+		if c is None:
 			return None
-		return resp
+		write, apicmd, params = c
+		if write:
+			return WhatsminerAPI.exec_command(self.token, apicmd, additional_params=params)
+		return WhatsminerAPI.get_read_only_info(self.token, apicmd, additional_params=params)
 
-	def get_psu_stats(self):
-		psu = self.run_command("get_psu")["Msg"]
+	async def async_run_command(self, cmd, args=None, timeout=5.0):
+		if not self.online:
+			await self.async_connect(timeout)
+		c = self._lookup_command(cmd, args)
+		if c is None:
+			return None
+		write, apicmd, params = c
+		if write:
+			return await AsyncWhatsminerAPI.exec_command(self.token, apicmd, additional_params=params, timeout=timeout)
+		return await AsyncWhatsminerAPI.get_read_only_info(self.token, apicmd, additional_params=params, timeout=timeout)
+
+	def parse_psu_stats(self, resp):
+		if resp is None:
+			return 0, 0, 0, 0
+		psu = resp["Msg"]
 		vin = int(psu["vin"]) / 100
 		iin = int(psu["iin"]) / 1000
 		fs = int(psu["fan_speed"])
 		pw = int(vin * iin)
 		return vin, iin, pw, fs
 
-	def get_summary_stats(self):
+	def parse_summary_stats(self, resp):
 		try:
-			s = self.run_command("summary")["SUMMARY"][0]
-		except (KeyError, json.JSONDecodeError):
+			s = resp["SUMMARY"][0]
+			hr = int(s["MHS av"]) / 1000000
+			voltage = int(s.get("Voltage", 0))/1000
+			fanin = int(s["Fan Speed In"])
+			fanout = int(s["Fan Speed Out"])
+			freq = int(s["freq_avg"])
+			temp = float(s["Temperature"])
+		except (KeyError, IndexError, TypeError, ValueError):
+			# Miner not up yet or malformed response
 			return 0, 0, 0, 0, 0, 0
-		if not "Voltage" in s:
-			s["Voltage"]=0.0
-		hr = int(s["MHS av"]) / 1000000
-		voltage = int(s["Voltage"])/1000
-		fanin = int(s["Fan Speed In"])
-		fanout = int(s["Fan Speed Out"])
-		freq = int(s["freq_avg"])
-		temp = float(s["Temperature"])
 		return voltage, fanin, fanout, freq, hr, temp
 
+	def get_psu_stats(self):
+		return self.parse_psu_stats(self.run_command("get_psu"))
+
+	def get_summary_stats(self):
+		try:
+			resp = self.run_command("summary")
+		except json.JSONDecodeError:
+			return 0, 0, 0, 0, 0, 0
+		return self.parse_summary_stats(resp)
+
+	async def async_get_psu_stats(self, timeout=5.0):
+		return self.parse_psu_stats(await self.async_run_command("get_psu", timeout=timeout))
+
+	async def async_get_summary_stats(self, timeout=5.0):
+		try:
+			resp = await self.async_run_command("summary", timeout=timeout)
+		except json.JSONDecodeError:
+			return 0, 0, 0, 0, 0, 0
+		return self.parse_summary_stats(resp)
+
+	async def async_poll(self, cmds, timeout=5.0):
+		"""
+		Run the read-only commands in cmds concurrently and return one merged
+		snapshot: {"ts": <time>, <cmd>: <response>, ..., "errors": {<cmd>: <exception>}}.
+		Commands that failed have a None response and an entry in "errors".
+		"""
+		if not self.online:
+			await self.async_connect(timeout)
+		ts = time()
+		resps = await asyncio.gather(*[self.async_run_command(c, timeout=timeout) for c in cmds],
+				return_exceptions=True)
+		snap = {"ts": ts, "errors": {}}
+		for c, r in zip(cmds, resps):
+			if isinstance(r, BaseException):
+				snap[c] = None
+				snap["errors"][c] = r
+			else:
+				snap[c] = r
+		return snap
+
+	def poll(self, cmds, timeout=5.0):
+		return asyncio.run(self.async_poll(cmds, timeout))
+
 	def stats(self):
-		s = self.run_command("summary")["SUMMARY"][0]
+		snap = self.poll(["summary", "edevs", "get_psu"])
+		if snap["errors"]:
+			raise next(iter(snap["errors"].values()))
+		s = snap["summary"]["SUMMARY"][0]
 		try:
-			e = self.run_command("edevs")["DEVS"]
-		except KeyError:
+			e = snap["edevs"]["DEVS"]
+			upfreq = ",".join([str(x["Upfreq Complete"]) for x in e])
+		except (KeyError, TypeError):
 			print("Device not up yet", flush=True)
 			upfreq = "0,0,0"
-		else:
-			upfreq = ",".join([str(x["Upfreq Complete"]) for x in e])
-		vin, iin, pw, _fs = self.get_psu_stats()
+		vin, iin, pw, _fs = self.parse_psu_stats(snap["get_psu"])
 		# pw = int(s["Power"])
 		hr = int(s["MHS av"]) / 1000000
-		if not "Voltage" in s:
-			s["Voltage"]=0.0
 		try:
 			eff = pw / hr
 		except ZeroDivisionError:
 			eff = 0
-		print(f'Power: {pw}W Voltage: {int(s["Voltage"])/1000:5.3f}V Fan speeds: {s["Fan Speed In"]}/{s["Fan Speed Out"]}rpm Freq: {s["freq_avg"]}MHz HR: {hr:4.1f}TH/s Eff: {eff:5.1f}J/Th Temp: {s["Temperature"]}\u00b0C upfreq: {upfreq}')
+		print(f'Power: {pw}W Voltage: {int(s.get("Voltage", 0))/1000:5.3f}V Fan speeds: {s["Fan Speed In"]}/{s["Fan Speed Out"]}rpm Freq: {s["freq_avg"]}MHz HR: {hr:4.1f}TH/s Eff: {eff:5.1f}J/Th Temp: {s["Temperature"]}\u00b0C upfreq: {upfreq}')
 
 	def psustats(self):
 		vin, iin, pin, fs = self.get_psu_stats()
 		print(f'Vin: {vin:4.1f} Vac Iin: {iin:4.3f} Aac Pin: {pin:5.1f} VA Fan speed: {fs} rpm')
 
+class PollScheduler:
+	"""
+	Adaptive poll interval for one miner.
+	Polls fast while the miner is ramping up (upfreq) or power changes a lot,
+	and for a while after a command was sent. Backs off towards SLOW while
+	values are stable. Never polls more often than MIN_INTERVAL.
+	"""
+	FAST = 2.0
+	NORMAL = 10.0
+	SLOW = 60.0
+	# Controller2 reacts on miner temperature changes, so don't back off as
+	# far while the miner is hashing.
+	SLOW_HASHING = 12.0
+	MIN_INTERVAL = 1.0
+	BACKOFF = 1.5
+	FAST_AFTER_COMMAND = 120.0
+
+	def __init__(self):
+		self.interval = self.NORMAL
+		self.fast_until = 0
+		self.t_last = 0
+		self.prev = None
+		self._kick = asyncio.Event()
+
+	def kick(self, duration=None):
+		"""
+		Poll now and keep polling fast for duration seconds.
+		"""
+		if duration is None:
+			duration = self.FAST_AFTER_COMMAND
+		self.fast_until = monotonic() + duration
+		self._kick.set()
+
+	def update(self, values, upfreq=False):
+		"""
+		Feed the values of the last poll, returns the new interval.
+		"""
+		prev, self.prev = self.prev, values
+		if upfreq or monotonic() < self.fast_until:
+			self.interval = self.FAST
+		elif prev is None:
+			self.interval = self.NORMAL
+		else:
+			dp = abs(values["Power"] - prev["Power"])
+			dtemp = abs(values["Temperature"] - prev["Temperature"])
+			if dp > max(100, 0.1 * prev["Power"]):
+				self.interval = self.FAST
+			elif dp > max(20, 0.02 * prev["Power"]) or dtemp > 1.0:
+				self.interval = self.NORMAL
+			else:
+				slow = self.SLOW if values["Power"] < 300 else self.SLOW_HASHING
+				self.interval = min(max(self.interval, self.NORMAL) * self.BACKOFF, slow)
+		return self.interval
+
+	async def wait(self):
+		timeout = max(self.t_last + self.interval - monotonic(), 0)
+		try:
+			await asyncio.wait_for(self._kick.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+		self._kick.clear()
+		dt = self.t_last + self.MIN_INTERVAL - monotonic()
+		if dt > 0:
+			await asyncio.sleep(dt)
+		self.t_last = monotonic()
+
+class SensorPacer:
+	"""
+	Deadband and max-interval publishing policy for the SENSOR object, similar
+	to ValuePacer in Controller2. The complete object is published if any field
+	moved more than its deadband, or max_interval seconds have passed.
+	"""
+	DEADBANDS = {
+		"VoltageIn": 1.0,
+		"CurrentIn": 0.2,
+		"Power": 20,
+		"PSUFanSpeed": 100,
+		"InputFanSpeed": 100,
+		"OuputFanSpeed": 100,
+		"VoltageChip": 0.01,
+		"Frequency": 5,
+		"HashRate": 1.0,
+		"Temperature": 0.5,
+	}
+
+	def __init__(self, deadbands=None, max_interval=30.0):
+		self.deadbands = self.DEADBANDS if deadbands is None else deadbands
+		self.max_interval = max_interval
+		self.reset()
+
+	def reset(self):
+		self.last = None
+		self.t_last = 0
+
+	def check(self, values):
+		"""
+		Returns True if values should be published now.
+		"""
+		t = monotonic()
+		if self.last is not None and t - self.t_last < self.max_interval:
+			changed = False
+			for k, v in values.items():
+				if abs(v - self.last.get(k, 0)) > self.deadbands.get(k, 0):
+					changed = True
+					break
+			if not changed:
+				return False
+		self.last = dict(values)
+		self.t_last = t
+		return True
+
 class HAMiner:
-	def __init__(self, whatsminer, mqtthost, mqttuser, mqttpass, hostname=None):
-		self._disconnected = asyncio.Event()
-		self.reconnect = True
-		self.retries = 3
+	"""
+	Home Assistant MQTT integration of a single miner. The MQTT client is
+	owned by HAFleet, so any number of miners can share one broker connection.
+	"""
+	# Range of the power target number entity in Watt
+	POWER_TARGET_MIN = 0
+	POWER_TARGET_MAX = 3600
+
+	def __init__(self, whatsminer, hostname=None, fleet=False):
 		if hostname is None:
 			hostname = socket.gethostname()
 		self.hostname = hostname
-		self.baseid = f"{self.hostname}_wmpower"
+		# HA discovery only accepts [a-zA-Z0-9_-] in node and object ids, in
+		# fleet mode hostname may be an address like 10.0.0.5:4028
+		slug = "".join(c if c.isalnum() or c in "_-" else "_" for c in self.hostname)
+		self.baseid = f"{slug}_wmpower"
 		self.wm = whatsminer
 		self.topicbase = f"wmpower/{self.hostname}/whatsminer"
-		self.client = gmqtt.Client("clientid")
-		self.client.on_disconnect = self.mqtt_disconnect
-		self.client.on_message = self.mqtt_message
-		self.client.set_auth_credentials(mqttuser, mqttpass)
-		self.mqtthost = mqtthost
+		# With more than one miner, HA object ids and names must be unique
+		self.objprefix = f"{slug}_" if fleet else ""
+		self.nameprefix = f"{self.hostname} " if fleet else ""
+		self.client = None
+		self.poll_cmds = ["get_psu", "summary", "edevs"]
+		# Last poll result, also served by the metrics exporter
+		self.snapshot = None
+		self.values = None
+		self.poll_duration = Histogram(POLL_DURATION_BUCKETS)
+		self.poll_errors = collections.Counter()
+		self.boards = BoardTracker()
+		self.scheduler = PollScheduler()
+		self.pacer = SensorPacer()
+		self.minerstate = None
+		self.powerctl = PowerController(self.wm)
+		# Background commands, referenced until done so they can't be garbage collected
+		self.tasks = set()
 
-	def mqtt_disconnect(self, client, packet, exc=None):
-		if self.retries <= 0:
-			self.reconnect = False
-		self._disconnected.set()
+	def spawn(self, coro):
+		"""
+		Run coro as a background task and report its exception, if any.
+		"""
+		task = asyncio.create_task(coro)
+		self.tasks.add(task)
+		task.add_done_callback(self._task_done)
+		return task
 
-	def mqtt_message(self, cient, topic, payload, qos, props):
+	def _task_done(self, task):
+		self.tasks.discard(task)
+		if not task.cancelled() and task.exception() is not None:
+			print(f"Error in {task.get_coro().__name__}: {task.exception()!r}", flush=True)
+
+	def mqtt_message(self, topic, payload):
 		print(f"MQTT RX topic:{topic}, payload:{payload!r}", flush=True)
 		tparts = topic.split("/")
 		if tparts[-1] == "mining":
@@ -136,131 +371,306 @@ class HAMiner:
 				print(f"Error, mining payload {onoff!r} not recognized!", flush=True)
 				return
 			print("Set minig to:", payload.decode("utf-8"), flush=True)
-			self.wm.run_command("power", [onoff])
+			self.spawn(self.power_command(onoff))
+		elif tparts[-1] == "power_target":
+			val = payload.decode("utf-8").lower()
+			if val in ("", "none", "off"):
+				target = None
+			else:
+				try:
+					target = float(val)
+				except ValueError:
+					target = math.nan
+				if not math.isfinite(target):
+					print(f"Error, power target {val!r} not recognized!", flush=True)
+					return
+				target = max(self.POWER_TARGET_MIN, min(self.POWER_TARGET_MAX, target))
+			print(f"Set power target to: {target}", flush=True)
+			self.set_power_target(target)
 
-	async def run_async_timed(self, func, *args, timeout=5.0):
-		loop = asyncio.get_running_loop()
-		return await asyncio.wait_for(loop.run_in_executor(None, func, *args), timeout)
+	def set_power_target(self, watts):
+		"""
+		Set closed-loop power target in Watt, None to disable power control.
+		"""
+		if self.wm.passwd is None:
+			print("Error, power control needs the admin password (-p)", flush=True)
+			return
+		self.powerctl.set_target(watts)
+		self.scheduler.kick()
+		if self.client is not None:
+			state = "None" if watts is None else str(watts)
+			self.client.publish(f"{self.topicbase}/power_target_state", state, qos=1, retain=True, content_type='utf-8')
 
-	async def get_psu_stats(self):
+	async def power_command(self, onoff):
 		try:
-			return await self.run_async_timed(self.wm.get_psu_stats)
+			await self.wm.async_run_command("power", [onoff])
+			# Follow the power transition closely
+			self.scheduler.kick()
 		except (TimeoutError, OSError, asyncio.exceptions.TimeoutError):
-			print("WM timeout in get_psu_stats", flush=True)
+			print(f"WM timeout in power command {onoff}", flush=True)
 			self.wm.set_offline()
-			return 0, 0, 0, 0
+		except WhatsminerAPIError as e:
+			print(f"WM error in power command {onoff}: {e}", flush=True)
 
-	async def get_summary_stats(self):
+	async def poll_stats(self):
+		"""
+		Poll the miner once and update snapshot, values and the poll statistics.
+		Returns the values dict that is published as SENSOR.
+		"""
+		cmds = self.poll_cmds
+		if self.boards.details is None:
+			# Static board information, only needed once
+			cmds = cmds + ["devdetails"]
+		t0 = monotonic()
 		try:
-			return await self.run_async_timed(self.wm.get_summary_stats)
-		except (TimeoutError, OSError, asyncio.exceptions.TimeoutError):
-			print("WM timeout in get_summary_stats", flush=True)
+			snap = await self.wm.async_poll(cmds)
+		except (TimeoutError, OSError, asyncio.exceptions.TimeoutError, WhatsminerAPIError) as e:
+			snap = {"ts": time(), "errors": {"connect": e}}
+		except Exception as e:
+			# Unexpected reply, must not take down the other miners of the fleet
+			snap = {"ts": time(), "errors": {"poll": e}}
+		self.poll_duration.observe(monotonic() - t0)
+		if snap["errors"]:
+			print(f"WM error in poll: {snap['errors']!r}", flush=True)
+			self.poll_errors.update(snap["errors"].keys())
 			self.wm.set_offline()
-			return 0, 0, 0, 0, 0, 0
+		vin, iin, pin, fs = self.wm.parse_psu_stats(snap.get("get_psu", None))
+		voltage, fanin, fanout, freq, hr, temp = self.wm.parse_summary_stats(snap.get("summary", None))
+		self.boards.update(snap.get("edevs", None), snap.get("devdetails", None), snap["ts"])
+		self.snapshot = snap
+		self.values = {
+			"VoltageIn": vin,
+			"CurrentIn": iin,
+			"Power": pin,
+			"PSUFanSpeed": fs,
+			"InputFanSpeed": fanin,
+			"OuputFanSpeed": fanout,
+			"VoltageChip": voltage,
+			"Frequency": freq,
+			"HashRate": hr,
+			"Temperature": temp
+		}
+		return self.values
 
-	async def shutdown(self):
-		self.reconnect = False
-		await self.client.disconnect()
+	def upfreq_running(self):
+		"""
+		True while the miner is hashing but not all boards finished upfreq.
+		"""
+		if self.values is None or self.values["Power"] < 300:
+			return False
+		edevs = self.snapshot.get("edevs", None)
+		try:
+			return any(int(x["Upfreq Complete"]) == 0 for x in edevs["DEVS"])
+		except (KeyError, TypeError, ValueError):
+			return False
 
-	async def run(self):
-		while True:
-			self._disconnected.clear()
-			if not self.reconnect:
+	async def coro_connection(self, client, disconnected):
+		self.client = client
+		# Publish everything once after (re)connecting
+		self.pacer.reset()
+		self.boards.published.clear()
+		self.minerstate = None
+		while not disconnected.is_set():
+			await self.scheduler.wait()
+			if disconnected.is_set():
 				break
-			print("MQTT: Connecting...", flush=True)
+			values = await self.poll_stats()
+			upfreq = self.upfreq_running()
+			self.scheduler.update(values, upfreq)
 			try:
-				await self.client.connect(self.mqtthost)
-			except (ConnectionRefusedError, OSError):
-				print("MQTT: Connection refused... retrying in 20 seconds.", flush=True)
-				await asyncio.sleep(20)
+				if await self.powerctl.update(values, upfreq):
+					self.scheduler.kick()
+			except (TimeoutError, OSError, asyncio.exceptions.TimeoutError):
+				print("WM timeout in power control", flush=True)
+				self.wm.set_offline()
+			except WhatsminerAPIError as e:
+				print(f"WM error in power control: {e}", flush=True)
+			except Exception as e:
+				print(f"WM error in power control: {e!r}", flush=True)
+				self.wm.set_offline()
+			if self.client is None:
 				continue
-			self.client.subscribe([
-				gmqtt.Subscription(f"{self.topicbase}/#", qos=1)
-			])
-			self.ha_config()
-			await self.coro_connection()
-			self.retries -= 1
-			if self.retries <= 0:
-				self.reconnect = False
-
-	async def coro_connection(self):
-		print("MQTT: Connected, processing messages", flush=True)
-		cnt = 0
-		while not self._disconnected.is_set():
-			vin, iin, pin, fs = await self.get_psu_stats()
-			voltage, fanin, fanout, freq, hr, temp = await self.get_summary_stats()
-			if temp > 0:
-				self.client.publish(f"{self.topicbase}/SENSOR", {
-					"VoltageIn": vin,
-					"CurrentIn": iin,
-					"Power": pin,
-					"PSUFanSpeed": fs,
-					"InputFanSpeed": fanin,
-					"OuputFanSpeed": fanout,
-					"VoltageChip": voltage,
-					"Frequency": freq,
-					"HashRate": hr,
-					"Temperature": temp
-				}, qos=1, content_type='json')
-			minerstate = "ON" if pin > 300 else "OFF"
-			self.client.publish(f"{self.topicbase}/state", minerstate, qos=1, content_type='utf-8')
-			await asyncio.sleep(10)
-			cnt += 1
-			if cnt > 10:
-				cnt = 0
-				self.ha_config()
+			if values["Temperature"] > 0 and self.pacer.check(values):
+				self.client.publish(f"{self.topicbase}/SENSOR", values, qos=1, content_type='json')
+			deltas = self.boards.deltas(BOARD_DEADBANDS)
+			if deltas:
+				self.client.publish(f"{self.topicbase}/BOARDS", deltas, qos=1, content_type='json')
+			minerstate = "ON" if values["Power"] > 300 else "OFF"
+			if minerstate != self.minerstate:
+				self.minerstate = minerstate
+				self.client.publish(f"{self.topicbase}/state", minerstate, qos=1, retain=True, content_type='utf-8')
 
 	def ha_config(self):
 		self.client.publish(f"homeassistant/switch/{self.baseid}S/config", {
-			"name": "Whatsminer mining",
-			"object_id": "whatsminer_mining_switch",
+			"name": f"{self.nameprefix}Whatsminer mining",
+			"object_id": f"{self.objprefix}whatsminer_mining_switch",
 			"unique_id": f"{self.baseid}S",
 			"~": self.topicbase,
 			"cmd_t": "~/mining",
 			"stat_t": "~/state",
-		}, qos=1, content_type='json')
+		}, qos=1, retain=True, content_type='json')
 		self.client.publish(f"homeassistant/sensor/{self.baseid}T/config", {
-			"name": "Whatsminer temperature",
-			"object_id": "whatsminer_temperature",
+			"name": f"{self.nameprefix}Whatsminer temperature",
+			"object_id": f"{self.objprefix}whatsminer_temperature",
 			"unique_id": f"{self.baseid}T",
 			"~": self.topicbase,
 			"stat_t": "~/SENSOR",
 			"unit_of_measurement": "°C",
 			"device_class": "temperature",
 			"value_template": "{{ value_json.Temperature}}"
-		}, qos=1, content_type='json')
+		}, qos=1, retain=True, content_type='json')
 		self.client.publish(f"homeassistant/sensor/{self.baseid}P/config", {
-			"name": "Whatsminer power",
-			"object_id": "whatsminer_power",
+			"name": f"{self.nameprefix}Whatsminer power",
+			"object_id": f"{self.objprefix}whatsminer_power",
 			"unique_id": f"{self.baseid}P",
 			"~": self.topicbase,
 			"stat_t": "~/SENSOR",
 			"unit_of_measurement": "W",
 			"device_class": "power",
 			"value_template": "{{ value_json.Power}}"
-		}, qos=1, content_type='json')
+		}, qos=1, retain=True, content_type='json')
 		self.client.publish(f"homeassistant/sensor/{self.baseid}HR/config", {
-			"name": "Whatsminer hash rate",
-			"object_id": "whatsminer_hashrate",
+			"name": f"{self.nameprefix}Whatsminer hash rate",
+			"object_id": f"{self.objprefix}whatsminer_hashrate",
 			"unique_id": f"{self.baseid}HR",
 			"~": self.topicbase,
 			"stat_t": "~/SENSOR",
 			"unit_of_measurement": "TH/s",
 			"value_template": "{{ value_json.HashRate}}"
-		}, qos=1, content_type='json')
+		}, qos=1, retain=True, content_type='json')
+		self.client.publish(f"homeassistant/number/{self.baseid}PT/config", {
+			"name": f"{self.nameprefix}Whatsminer power target",
+			"object_id": f"{self.objprefix}whatsminer_power_target",
+			"unique_id": f"{self.baseid}PT",
+			"~": self.topicbase,
+			"cmd_t": "~/power_target",
+			"stat_t": "~/power_target_state",
+			"min": self.POWER_TARGET_MIN,
+			"max": self.POWER_TARGET_MAX,
+			"step": 50,
+			"unit_of_measurement": "W",
+			"device_class": "power",
+		}, qos=1, retain=True, content_type='json')
+
+class HAFleet:
+	"""
+	Shared MQTT connection for one or more HAMiner instances. All miners are
+	polled concurrently from the same event loop.
+	"""
+	def __init__(self, miners, mqtthost, mqttuser, mqttpass, metrics_port=None):
+		self._disconnected = asyncio.Event()
+		self.reconnect = True
+		self.retries = 3
+		self.miners = miners
+		self.metrics_port = metrics_port
+		self.client = gmqtt.Client("clientid")
+		self.client.on_disconnect = self.mqtt_disconnect
+		self.client.on_message = self.mqtt_message
+		self.client.set_auth_credentials(mqttuser, mqttpass)
+		self.mqtthost = mqtthost
+
+	def mqtt_disconnect(self, client, packet, exc=None):
+		if self.retries <= 0:
+			self.reconnect = False
+		self._disconnected.set()
+
+	def mqtt_message(self, cient, topic, payload, qos, props):
+		for m in self.miners:
+			if topic.startswith(m.topicbase + "/"):
+				m.mqtt_message(topic, payload)
+				return
+		print(f"MQTT RX unhandled topic:{topic}, payload:{payload!r}", flush=True)
+
+	async def shutdown(self):
+		self.reconnect = False
+		await self.client.disconnect()
+
+	async def supervise(self, miner, client):
+		"""
+		Run miner.coro_connection until disconnected, restarting it after an
+		unexpected error so one miner can't take down the rest of the fleet.
+		"""
+		while not self._disconnected.is_set():
+			try:
+				await miner.coro_connection(client, self._disconnected)
+			except Exception as e:
+				print(f"{miner.hostname}: error in miner task: {e!r}, restarting", flush=True)
+				miner.poll_errors["task"] += 1
+				miner.wm.set_offline()
+				await asyncio.sleep(10)
+
+	async def run(self):
+		if self.metrics_port is not None:
+			await MetricsServer(self.miners, self.metrics_port).start()
+		if self.mqtthost is None:
+			# Exporter only, no broker
+			await asyncio.gather(*[self.supervise(m, None) for m in self.miners])
+			return
+		while True:
+			self._disconnected.clear()
+			if not self.reconnect:
+				break
+			print("MQTT: Connecting...", flush=True)
+			try:
+				await self.client.connect(self.mqtthost)
+			except (ConnectionRefusedError, OSError):
+				print("MQTT: Connection refused... retrying in 20 seconds.", flush=True)
+				await asyncio.sleep(20)
+				continue
+			self.client.subscribe([
+				gmqtt.Subscription(f"{m.topicbase}/#", qos=1) for m in self.miners
+			])
+			for m in self.miners:
+				m.client = self.client
+				m.ha_config()
+			print(f"MQTT: Connected, processing messages for {len(self.miners)} miner(s)", flush=True)
+			await asyncio.gather(*[self.supervise(m, self.client) for m in self.miners])
+			self.retries -= 1
+			if self.retries <= 0:
+				self.reconnect = False
+
+def read_fleet_file(fname):
+	"""
+	Read a fleet file with one miner per line: <host> [<hostname>]
+	<hostname> is used in the MQTT topic and defaults to <host>.
+	Empty lines and lines starting with '#' are ignored.
+	"""
+	ret = []
+	with open(fname, "r") as f:
+		for l in f:
+			l = l.strip()
+			if not l or l.startswith("#"):
+				continue
+			parts = l.split()
+			host = parts[0]
+			name = parts[1] if len(parts) > 1 else host
+			ret.append((host, name))
+	return ret
 
 def main(args):
 	"""
 	Usage:
 		wmpower.py -h <host> [-p <password>] command [args]
+		wmpower.py -h <host> [-h <host> ...] -m <mqtthost> [options]
+		wmpower.py -f <fleetfile> [-m <mqtthost>] [-e <port>] [options]
 
 	Options:
-		-h <host>       : Specify hostname/ip-address of miner
+		-h <host>       : Specify hostname/ip-address of miner. Can be repeated in
+		                  MQTT or exporter mode to run a fleet of miners from one
+		                  process. Use <host>:<port> for a non-standard API port.
+		-f <fleetfile>  : Read miners from <fleetfile>, one "<host> [<hostname>]"
+		                  per line. Implies fleet mode, requires -m or -e.
 		-p <password>   : Admin password, needed only for non read-only commands
 		-m <mqtthost>   : Start MQTT client connected to <mqtthost>
 		-u <mqttuser>   : Specify the user or token to authenticate to MQTT broker
 		-w <mqttpasswd> : Specify optional MQTT broker password
-		-H <hostname>   : Use <hostname> for MQTT topic instead of own hostname
+		-e <port>       : Serve Prometheus metrics on http://<host>:<port>/metrics.
+		                  Can be used with or without -m.
+		-c <seconds>    : Cache read-only miner responses for <seconds>, so that all
+		                  consumers in this process share one poll result.
+		-H <hostname>   : Use <hostname> for MQTT topic instead of own hostname.
+		                  In fleet mode the miner host is used unless specified
+		                  in the fleet file.
 		--help          : Display this help text
 
 	Environment Variables to avoid leaking credentials to the command line:
@@ -275,21 +685,27 @@ def main(args):
 		status          : Print miner status in json format
 		led auto        : Set LED mode back to "auto" (other modes unknown)
 		edevs           : Print hash board status in json format
+		devdetails      : Print hash board details in json format
 		get_psu         : Print PSU status in json format
 	"""
-	host = None
+	hosts = []
 	passwd = os.environ.get("WMPOWER_PASSWD", None)
 	command = None
 	resp = None
 	mqtthost = None
+	metrics_port = None
 	hostname = None
 	mqttuser = os.environ.get("WMPOWER_MQTTUSER", None)
 	mqttpasswd = os.environ.get("WMPOWER_MQTTPASSWD", None)
 	cmdargs = []
+	fleet = False
 	while args:
 		a = args.pop(0)
 		if a == "-h":
-			host = args.pop(0)
+			hosts.append((args.pop(0), None))
+		elif a == "-f":
+			hosts += read_fleet_file(args.pop(0))
+			fleet = True
 		elif a == "-p":
 			passwd = args.pop(0)
 		elif a == "-m":
@@ -300,6 +716,10 @@ def main(args):
 			mqttpasswd = args.pop(0)
 		elif a == "-H":
 			hostname = args.pop(0)
+		elif a == "-e":
+			metrics_port = int(args.pop(0))
+		elif a == "-c":
+			read_only_cache.ttl = float(args.pop(0))
 		elif a == "--help":
 			print(inspect.cleandoc(main.__doc__))
 			return 0
@@ -307,15 +727,24 @@ def main(args):
 			command = a
 			cmdargs = args
 			break
-	if host is None:
+	if not hosts:
 		print("Error must provide hostname/ip-address")
 		print(inspect.cleandoc(main.__doc__))
 		return 1
-	w = Whatsminer(host, passwd)
-	if mqtthost is not None:
-		haminer = HAMiner(w, mqtthost, mqttuser, mqttpasswd, hostname)
-		asyncio.run(haminer.run())
-	elif command is None:
+	fleet = fleet or len(hosts) > 1
+	if fleet and mqtthost is None and metrics_port is None:
+		print("Error: fleet mode (-f or multiple -h) is only supported in MQTT (-m) or exporter (-e) mode")
+		return 1
+	if mqtthost is not None or metrics_port is not None:
+		if fleet:
+			miners = [HAMiner(Whatsminer(h, passwd), n or h, fleet=True) for h, n in hosts]
+		else:
+			miners = [HAMiner(Whatsminer(hosts[0][0], passwd), hosts[0][1] or hostname)]
+		hafleet = HAFleet(miners, mqtthost, mqttuser, mqttpasswd, metrics_port)
+		asyncio.run(hafleet.run())
+		return 0
+	w = Whatsminer(hosts[0][0], passwd)
+	if command is None:
 		w.stats()
 	elif command == "psustats":
 		w.psustats()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import random
+import inspect
+import asyncio
+import hashlib
+import binascii
+from time import time, monotonic
+from base64 import b64encode, b64decode
+from Cryptodome.Cipher import AES
+from whatsminer.api import crypt
+
+class SimMiner:
+	"""
+	Simulated Whatsminer M31S. Power and hash rate follow a ramp after
+	power_on and scale with the set_target_freq percentage.
+	"""
+	NOMINAL_POWER = 3400
+	NOMINAL_HASHRATE = 80.0 # TH/s
+	IDLE_POWER = 110
+	BOARDS = 3
+
+	def __init__(self, passwd="admin", upfreq_time=120.0, mining=True):
+		self.passwd = passwd
+		self.upfreq_time = upfreq_time
+		self.percent = 0
+		self.t_on = monotonic() - upfreq_time if mining else None
+		self.salt = "".join(random.choice("abcdefghABCDEFGH01234567") for i in range(8))
+		self.newsalt = "".join(random.choice("abcdefghABCDEFGH01234567") for i in range(8))
+		self.t_token = None
+		self.key = crypt(passwd, "$1$" + self.salt + '$').split('$')[3]
+		aeskey = binascii.unhexlify(hashlib.sha256(self.key.encode()).hexdigest().encode())
+		self.cipher = AES.new(aeskey, AES.MODE_ECB)
+		self.sign = None
+		self.hw_errors = [0] * self.BOARDS
+
+	def ramp(self):
+		"""
+		Fraction of full power, 0 while off, rising to 1 during upfreq.
+		"""
+		if self.t_on is None:
+			return 0.0
+		return min(1.0, (monotonic() - self.t_on) / self.upfreq_time)
+
+	def power(self):
+		r = self.ramp()
+		if r == 0:
+			return self.IDLE_POWER
+		p = self.NOMINAL_POWER * (1 + 0.0114 * self.percent)
+		return self.IDLE_POWER + r * (p - self.IDLE_POWER) + random.uniform(-15, 15)
+
+	def hashrate(self):
+		return self.ramp() * self.NOMINAL_HASHRATE * (1 + self.percent / 100) * random.uniform(0.97, 1.03)
+
+	def temperature(self):
+		return 25 + 0.012 * (self.power() - self.IDLE_POWER) + random.uniform(-0.3, 0.3)
+
+	def freq(self):
+		return int(self.ramp() * 600 * (1 + self.percent / 100))
+
+	def _status(self, msg=None, code=131):
+		ret = {"STATUS": "S", "When": int(time()), "Code": code, "Description": ""}
+		if msg is not None:
+			ret["Msg"] = msg
+		return ret
+
+	def get_token(self):
+		t = str(int(time()))[-4:]
+		if t != self.t_token:
+			self.t_token = t
+			self.sign = crypt(self.key + t, "$1$" + self.newsalt + '$').split('$')[3]
+		return self._status({"time": t, "salt": self.salt, "newsalt": self.newsalt}, 134)
+
+	def summary(self):
+		fan = int(2000 + 2 * (self.power() - self.IDLE_POWER) / 3)
+		return {
+			"STATUS": [{"STATUS": "S", "Msg": "Summary"}],
+			"SUMMARY": [{
+				"Elapsed": 1000,
+				"MHS av": round(self.hashrate() * 1000000, 2),
+				"MHS 5s": round(self.hashrate() * 1000000, 2),
+				"Temperature": round(self.temperature(), 2),
+				"freq_avg": self.freq(),
+				"Fan Speed In": fan,
+				"Fan Speed Out": fan,
+				"Voltage": 1300 if self.ramp() else 0,
+				"Power": int(self.power()),
+				"Power Mode": "Normal",
+				"Target Freq": self.percent,
+			}]
+		}
+
+	def edevs(self):
+		devs = []
+		up = 1 if self.ramp() >= 1.0 else 0
+		for i in range(self.BOARDS):
+			if self.ramp() and random.random() < 0.1:
+				self.hw_errors[i] += 1
+			t = self.temperature()
+			devs.append({
+				"ASC": i,
+				"Slot": i,
+				"Enabled": "Y",
+				"Status": "Alive",
+				"Temperature": round(t, 2),
+				"Chip Frequency": self.freq(),
+				"MHS av": round(self.hashrate() * 1000000 / self.BOARDS, 2),
+				"Upfreq Complete": up,
+				"Effective Chips": 156,
+				"Chip Temp Min": round(t + 5, 2),
+				"Chip Temp Max": round(t + 15, 2),
+				"Chip Temp Avg": round(t + 10, 2),
+				"Hardware Errors": self.hw_errors[i],
+			})
+		return {"STATUS": [{"STATUS": "S", "Msg": "EDevs"}], "DEVS": devs}
+
+	def devdetails(self):
+		return {"STATUS": [{"STATUS": "S", "Msg": "Device Details"}], "DEVDETAILS": [
+			{"DEVDETAILS": i, "Name": "SM", "ID": i, "Driver": "bitmicro", "Kernel": "", "Model": "M31S.V10"}
+			for i in range(self.BOARDS)
+		]}
+
+	def get_psu(self):
+		p = self.power()
+		return self._status({
+			"name": "P221B",
+			"hw_version": "V01.00",
+			"sw_version": "V01.00.V01.03",
+			"model": "P221B",
+			"iin": str(int(p / 230 * 1000)),
+			"vin": "23000",
+			"fan_speed": str(int(3000 + p / 2)),
+			"version": "",
+			"serial_no": "SIM",
+			"vendor": "1",
+		})
+
+	def status(self):
+		return self._status({"btmineroff": "false" if self.t_on else "true", "Firmware Version": "'20210322.22.REL'"})
+
+	def read_only(self, cmd):
+		f = {
+			"summary": self.summary,
+			"edevs": self.edevs,
+			"devdetails": self.devdetails,
+			"get_psu": self.get_psu,
+			"status": self.status,
+			"get_token": self.get_token,
+		}.get(cmd, None)
+		if f is None:
+			return {"STATUS": "E", "When": int(time()), "Code": 14, "Msg": "invalid cmd", "Description": ""}
+		return f()
+
+	def write(self, obj):
+		if self.sign is None or obj.get("token", None) != self.sign:
+			return {"STATUS": "E", "When": int(time()), "Code": 135, "Msg": "check token err", "Description": ""}
+		cmd = obj.get("cmd", None)
+		if cmd == "power_on":
+			if self.t_on is None:
+				self.t_on = monotonic()
+		elif cmd == "power_off":
+			self.t_on = None
+		elif cmd == "set_target_freq":
+			self.percent = max(-90, min(100, int(obj.get("percent", 0))))
+		elif cmd not in ("set_led",):
+			return {"STATUS": "E", "When": int(time()), "Code": 14, "Msg": "invalid cmd", "Description": ""}
+		return self._status()
+
+	def encrypt(self, obj):
+		b = json.dumps(obj).encode()
+		b += bytes(-len(b) % 16)
+		return {"enc": b64encode(self.cipher.encrypt(b)).decode()}
+
+	def decrypt(self, data):
+		return json.loads(self.cipher.decrypt(b64decode(data)).split(b"\x00")[0])
+
+# Responses that are affected by broken JSON on real firmware
+MALFORMABLE = ("summary", "edevs", "devdetails", "get_psu")
+
+def malform(s):
+	"""
+	Introduce one of the JSON defects seen in real firmware.
+	"""
+	kind = random.choice(("trailing_comma", "missing_comma", "nul_padding"))
+	if kind == "trailing_comma" and s.endswith("}]}"):
+		return s[:-3] + ",}]}"
+	if kind == "missing_comma" and '", "' in s:
+		i = s.index('", "')
+		return s[:i] + '""' + s[i + 4:]
+	return s + "\x00" * random.randint(1, 16)
+
+class SimServer:
+	"""
+	Whatsminer API server on top of a SimMiner.
+	"""
+	def __init__(self, miner, port=4028, host="127.0.0.1", latency=0.0, jitter=0.0,
+			max_conn=10, malformed=0.0, keepalive=False):
+		self.miner = miner
+		self.port = port
+		self.host = host
+		self.latency = latency
+		self.jitter = jitter
+		self.max_conn = max_conn
+		self.malformed = malformed
+		self.keepalive = keepalive
+		self.nconn = 0
+		self.requests = 0
+		self.rejected = 0
+
+	async def start(self):
+		self.server = await asyncio.start_server(self.handle, self.host, self.port)
+
+	def answer(self, req):
+		"""
+		Returns the response as string.
+		"""
+		try:
+			obj = json.loads(req)
+		except ValueError:
+			return json.dumps({"STATUS": "E", "When": int(time()), "Code": 23, "Msg": "invalid JSON", "Description": ""})
+		if obj.get("enc", None):
+			try:
+				cmd = self.miner.decrypt(obj["data"])
+			except (ValueError, KeyError):
+				return json.dumps({"STATUS": "E", "When": int(time()), "Code": 136, "Msg": "decode err", "Description": ""})
+			ret = self.miner.write(cmd)
+			if ret.get("STATUS", None) == "E":
+				return json.dumps(ret)
+			return json.dumps(self.miner.encrypt(ret))
+		cmd = obj.get("cmd", None)
+		s = json.dumps(self.miner.read_only(cmd))
+		if cmd in MALFORMABLE and random.random() < self.malformed:
+			s = malform(s)
+		return s
+
+	async def handle(self, reader, writer):
+		self.nconn += 1
+		try:
+			if self.nconn > self.max_conn:
+				self.rejected += 1
+				writer.write(json.dumps({"STATUS": "E", "When": int(time()), "Code": 135,
+						"Msg": "over max connect", "Description": ""}).encode())
+				await writer.drain()
+				return
+			while True:
+				req = await reader.read(8192)
+				if not req:
+					break
+				self.requests += 1
+				delay = self.latency + random.uniform(0, self.jitter)
+				if delay > 0:
+					await asyncio.sleep(delay)
+				writer.write(self.answer(req).encode())
+				await writer.drain()
+				if not self.keepalive:
+					break
+		except OSError:
+			pass
+		finally:
+			self.nconn -= 1
+			writer.close()
+
+async def run_servers(servers):
+	for s in servers:
+		await s.start()
+	print(f"wmsim: {len(servers)} simulated miner(s) on ports {servers[0].port}..{servers[-1].port}", flush=True)
+	while True:
+		await asyncio.sleep(3600)
+
+def main(args):
+	"""
+	Usage:
+		wmsim.py [options]
+
+	Simulate one or more Whatsminer M31S miners speaking the Whatsminer API.
+
+	Options:
+		-b <address>    : Bind to <address> (default 127.0.0.1)
+		-P <port>       : Port of the first miner (default 4028)
+		-n <count>      : Number of miners on consecutive ports (default 1)
+		-p <password>   : Admin password (default "admin")
+		-l <seconds>    : Response latency (default 0)
+		-j <seconds>    : Additional random latency up to <seconds> (default 0)
+		-c <count>      : Maximum concurrent connections per miner (default 10)
+		-e <fraction>   : Fraction of responses with malformed JSON (default 0)
+		-u <seconds>    : Upfreq ramp time after power_on (default 120)
+		-k              : Keep connections open after a response
+		-o              : Start with mining off
+		--help          : Display this help text
+
+	Point wmpower at a simulated miner with -h <address>:<port>.
+	"""
+	host = "127.0.0.1"
+	port = 4028
+	count = 1
+	passwd = "admin"
+	latency = 0.0
+	jitter = 0.0
+	max_conn = 10
+	malformed = 0.0
+	upfreq = 120.0
+	keepalive = False
+	mining = True
+	while args:
+		a = args.pop(0)
+		if a == "-b":
+			host = args.pop(0)
+		elif a == "-P":
+			port = int(args.pop(0))
+		elif a == "-n":
+			count = int(args.pop(0))
+		elif a == "-p":
+			passwd = args.pop(0)
+		elif a == "-l":
+			latency = float(args.pop(0))
+		elif a == "-j":
+			jitter = float(args.pop(0))
+		elif a == "-c":
+			max_conn = int(args.pop(0))
+		elif a == "-e":
+			malformed = float(args.pop(0))
+		elif a == "-u":
+			upfreq = float(args.pop(0))
+		elif a == "-k":
+			keepalive = True
+		elif a == "-o":
+			mining = False
+		elif a == "--help":
+			print(inspect.cleandoc(main.__doc__))
+			return 0
+		else:
+			print(f"Error: unknown option {a}")
+			print(inspect.cleandoc(main.__doc__))
+			return 1
+	servers = [SimServer(SimMiner(passwd, upfreq, mining), port + i, host, latency, jitter,
+			max_conn, malformed, keepalive) for i in range(count)]
+	try:
+		asyncio.run(run_servers(servers))
+	except KeyboardInterrupt:
+		pass
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))